@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the filtering and fill and drain algorithms.
+
+Run from the repository root with:
+    python -m benchmarks.run
+
+src is put on the path when the package is not installed.
+"""
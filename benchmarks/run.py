@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Time the algorithms on synthetic data and compare against a stored baseline.
+
+Usage, from the repository root (src is put on the path when the package is
+not installed):
+    python -m benchmarks.run              report against baseline.json
+    python -m benchmarks.run --save       store this run as the baseline
+    python -m benchmarks.run --check      exit 1 on a regression
+
+baseline.json is per host and not committed, save one before checking.
+Every case is compared relative to a fixed reference workload timed in the
+same run, so a busier or slower host does not read as a regression.
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+if str(SRC) not in sys.path:
+    sys.path.insert(0, str(SRC))
+
+from tools.algorithms.fill_and_drain_inference import (  # noqa: E402
+    find_md_stuff,
+    infer_fill_and_drain,
+)
+from tools.algorithms.production_filtering import (  # noqa: E402
+    infer_prod_rate,
+    infer_tank_level,
+    product_calculations,
+)
+
+from . import synthetic  # noqa: E402
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+SIZES = {"1d": 1440, "1w": 7 * 1440, "3m": 90 * 1440}
+TOLERANCE = 0.25
+
+
+def md_data(minutes: int):
+    data = synthetic.tank_data(minutes)
+    xs, mds, _ = infer_tank_level(data.tank_volume)
+    data["filtered_vol_fwd"] = xs[:, 0]
+    data["fwd_mds"] = mds
+    data["row_num"] = range(len(data))
+    return data
+
+
+def reference_case():
+    """Fixed work outside the package that times how fast the host is now."""
+    values = np.random.default_rng(0).normal(size=(SIZES["1w"], 3))
+    transition = np.eye(3) * 0.9
+
+    def work():
+        x = np.zeros(3)
+        for value in values:
+            x = transition @ x + value
+        return pd.Series(values[:, 0]).rolling(60).mean().sum(), x
+
+    return work
+
+
+def product_calculations_case(minutes: int):
+    data = synthetic.product_data(minutes)
+    return lambda: product_calculations(data)
+
+
+def tank_level_case(minutes: int):
+    data = synthetic.tank_levels(minutes)
+    return lambda: infer_tank_level(data)
+
+
+def prod_rate_case(minutes: int):
+    data = synthetic.product_data(minutes)
+    return lambda: infer_prod_rate(data)
+
+
+def find_md_stuff_case(minutes: int):
+    data = md_data(minutes)
+    return lambda: find_md_stuff(data, "fwd_mds", "row_num", "filtered_vol_fwd", -1)
+
+
+def fill_and_drain_case(minutes: int):
+    data = synthetic.tank_data(minutes)
+    return lambda: infer_fill_and_drain(data.copy(), data.index[0], data.index[-1])
+
+
+CASES = {
+    "infer_tank_level": tank_level_case,
+    "infer_prod_rate": prod_rate_case,
+    "find_md_stuff": find_md_stuff_case,
+    "infer_fill_and_drain": fill_and_drain_case,
+    "product_calculations": product_calculations_case,
+}
+
+
+def timed(func: Callable[[], object]) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def measure(
+    func: Callable[[], object], reference: Callable[[], object], repeat: int
+) -> Dict[str, float]:
+    """Peak traced memory of one run, then the best wall time of repeat runs
+    and its median ratio to the reference work timed right after each run.
+
+    The traced run also warms up caches, so it is not part of the timings.
+    """
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    reference()
+    times = []
+    ratios = []
+    for _ in range(repeat):
+        times.append(timed(func))
+        ratios.append(times[-1] / timed(reference))
+    return {
+        "wall": min(times),
+        "relative": float(np.median(ratios)),
+        "peak_mb": peak / 2 ** 20,
+    }
+
+
+def run(
+    cases: List[str], sizes: List[str], repeat: int
+) -> Dict[str, Dict[str, float]]:
+    reference = reference_case()
+    results = {}
+    for name in cases:
+        for size in sizes:
+            minutes = SIZES[size]
+            result = measure(CASES[name](minutes), reference, repeat)
+            result["rows_per_s"] = minutes / result["wall"]
+            results[f"{name}/{size}"] = result
+    return results
+
+
+def report(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float = TOLERANCE,
+):
+    regressions = []
+    print(
+        f"{'case':<28}{'wall s':>10}{'peak MiB':>10}{'rows/s':>12}"
+        f"{'vs base':>10}"
+    )
+    for key, result in results.items():
+        line = (
+            f"{key:<28}{result['wall']:>10.4f}{result['peak_mb']:>10.1f}"
+            f"{result['rows_per_s']:>12.0f}"
+        )
+        if "relative" in baseline.get(key, {}):
+            ratio = result["relative"] / baseline[key]["relative"]
+            line += f"{ratio:>9.2f}x"
+            if ratio > 1 + tolerance:
+                line += "  REGRESSION"
+                regressions.append(key)
+        print(line)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--case", action="append", choices=list(CASES))
+    parser.add_argument("--size", action="append", choices=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", action="store_true", help="store as baseline")
+    parser.add_argument("--check", action="store_true", help="fail on regression")
+    parser.add_argument(
+        "--tolerance", type=float, default=TOLERANCE, help="slowdown allowed"
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.case or list(CASES), args.size or list(SIZES), args.repeat)
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        baseline.update(results)
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"saved baseline to {BASELINE}")
+    if args.check and regressions:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
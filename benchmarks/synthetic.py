@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Seeded, minute level tank and flow signals that look like historian pulls."""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+START = pd.Timestamp("2020-01-01")
+
+
+def minute_index(minutes: int, start: pd.Timestamp = START) -> pd.DatetimeIndex:
+    return pd.date_range(start=start, periods=minutes, freq="min", name="datetime")
+
+
+def tank_levels(
+    minutes: int,
+    seed: int = 0,
+    capacity: float = 100,
+    usage_per_day: float = 4,
+    fills_per_week: float = 2,
+    fill_minutes: int = 6,
+    noise: float = 0.05,
+    dropouts_per_day: float = 1,
+    dropout_minutes: int = 20,
+) -> pd.Series:
+    """Chemical tank level that drains steadily and is topped up now and then.
+
+    Params:
+        minutes: length of the series
+        seed: seed of the random generator
+        capacity: level a fill tops the tank up to
+        usage_per_day: level drained per day
+        fills_per_week: average number of fills per week
+        fill_minutes: how long a fill takes
+        noise: standard deviation of the sensor noise
+        dropouts_per_day: average number of sensor dropouts per day
+        dropout_minutes: longest dropout, the level holds its last value
+
+    Returns:
+        series: tank levels indexed by minute
+    """
+    rng = np.random.default_rng(seed)
+    usage = rng.normal(usage_per_day / 1440, usage_per_day / 14400, minutes)
+    fills = np.zeros(minutes)
+    n_fills = rng.poisson(fills_per_week * minutes / 10080)
+    for start in rng.integers(0, minutes, n_fills):
+        fills[start : start + fill_minutes] = rng.uniform(0.3, 0.6) * capacity / fill_minutes
+    levels = np.empty(minutes)
+    level = capacity * rng.uniform(0.5, 0.9)
+    for i, (used, filled) in enumerate(zip(usage.tolist(), fills.tolist())):
+        level = min(max(level - used + filled, 0), capacity)
+        levels[i] = level
+    levels += rng.normal(0, noise, minutes)
+
+    n_dropouts = rng.poisson(dropouts_per_day * minutes / 1440)
+    for start in rng.integers(1, max(minutes, 2), n_dropouts):
+        levels[start : start + rng.integers(1, dropout_minutes + 1)] = np.nan
+    return pd.Series(levels, index=minute_index(minutes), name="tank_volume").ffill()
+
+
+def inlet_flowrate(minutes: int, seed: int = 0, mean: float = 3.0) -> pd.Series:
+    """Inlet flow in thousands of scfm with a daily swing and noise."""
+    rng = np.random.default_rng(seed)
+    daily = 0.1 * mean * np.sin(np.arange(minutes) * 2 * np.pi / 1440)
+    values = np.clip(mean + daily + rng.normal(0, 0.02 * mean, minutes), 0, None)
+    return pd.Series(values, index=minute_index(minutes), name="inlet_flowrate")
+
+
+def product_data(minutes: int, seed: int = 0) -> pd.DataFrame:
+    """Product tank that fills from the process and is pumped out in batches.
+
+    Returns:
+        dataframe: product_tank_volume, product_flowrate and inlet_flowrate
+            indexed by minute
+    """
+    rng = np.random.default_rng(seed)
+    fill_rate = np.clip(rng.normal(0.5, 0.05, minutes), 0, None)
+    pumping = np.zeros(minutes)
+    n_batches = rng.poisson(3 * minutes / 1440)
+    for start in rng.integers(0, minutes, n_batches):
+        pumping[start : start + rng.integers(30, 90)] = rng.uniform(2, 4)
+    volume = np.empty(minutes)
+    level = rng.uniform(200, 400)
+    for i, (filled, pumped) in enumerate(zip(fill_rate.tolist(), pumping.tolist())):
+        level = max(level + filled - pumped, 0)
+        volume[i] = level
+    index = minute_index(minutes)
+    return pd.DataFrame(
+        {
+            "product_tank_volume": volume + rng.normal(0, 1, minutes),
+            "product_flowrate": pumping + rng.normal(0, 0.05, minutes),
+            "inlet_flowrate": inlet_flowrate(minutes, seed).values,
+        },
+        index=index,
+    )
+
+
+def tank_data(minutes: int, seed: int = 0) -> pd.DataFrame:
+    """Frame in the shape infer_fill_and_drain expects."""
+    return pd.DataFrame(
+        {
+            "tank_volume": tank_levels(minutes, seed),
+            "inlet_flowrate": inlet_flowrate(minutes, seed),
+        }
+    )
@@ -3,9 +3,7 @@ from __future__ import annotations
 
 import datetime as dt
 
-from dataclasses import dataclass
-from typing import List, Optional
-
+import numpy as np
 import pandas as pd
 
 from scipy.signal import find_peaks, peak_widths
@@ -15,19 +13,63 @@ from .production_filtering import infer_tank_level
 pd.options.mode.chained_assignment = None
 
 
-@dataclass
 class TankChanges:
-    start_time: Optional[dt.datetime] = None
-    start_level: Optional[float] = None
-    forward_md: Optional[float] = None
-    end_time: Optional[dt.datetime] = None
-    end_level: Optional[float] = None
-    backward_md: Optional[float] = None
+    """Candidate tank level changes, one array per field.
+
+    Missing times are NaT and missing levels or distances are NaN.
+    """
+
+    __slots__ = (
+        "start_time",
+        "start_level",
+        "forward_md",
+        "end_time",
+        "end_level",
+        "backward_md",
+    )
+
+    def __init__(
+        self,
+        start_time=(),
+        start_level=(),
+        forward_md=(),
+        end_time=(),
+        end_level=(),
+        backward_md=(),
+    ):
+        self.start_time = np.asarray(start_time, dtype="datetime64[ns]")
+        self.start_level = np.asarray(start_level, dtype=float)
+        self.forward_md = np.asarray(forward_md, dtype=float)
+        self.end_time = np.asarray(end_time, dtype="datetime64[ns]")
+        self.end_level = np.asarray(end_level, dtype=float)
+        self.backward_md = np.asarray(backward_md, dtype=float)
+
+    @classmethod
+    def from_md_values(cls, fwd_values: dict, bkwd_values: dict) -> TankChanges:
+        """Pair forward and backward find_md_stuff results in order."""
+        n = min(len(fwd_values["level"]), len(bkwd_values["level"]))
+        return cls(
+            fwd_values["peak_min_time"][:n],
+            fwd_values["level"][:n],
+            fwd_values["peak"][:n],
+            bkwd_values["peak_min_time"][:n],
+            bkwd_values["level"][:n],
+            bkwd_values["peak"][:n],
+        )
+
+    def __len__(self):
+        return len(self.start_level)
+
+    def __getitem__(self, key) -> TankChanges:
+        return TankChanges(*(getattr(self, field)[key] for field in self.__slots__))
 
     @property
     def volume_differnce(self):
         return self.start_level - self.end_level
 
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({field: getattr(self, field) for field in self.__slots__})
+
 
 class EliminateFalseReadings:
     strategies = []
@@ -40,165 +82,91 @@ class EliminateFalseReadings:
         cls.strategies.append(strategy())
         return strategy
 
-    def eliminate(self, readings):
+    def eliminate(self, readings: TankChanges) -> TankChanges:
+        keep = np.ones(len(readings), dtype=bool)
         for strategy in self.strategies:
-            readings = strategy.eliminate(readings)
-        return readings
+            keep &= strategy.mask(readings)
+        return readings[keep]
 
 
-@EliminateFalseReadings.register
 class FalseReadingStrategy:
-    def eliminate(self, readings: List[TankChanges]) -> List[TankChanges]:
+    def mask(self, readings: TankChanges) -> np.ndarray:
         return NotImplemented
 
 
 @EliminateFalseReadings.register
 class TooMany(FalseReadingStrategy):
-    def eliminate(self, readings: List[TankChanges]):
-        return [TankChanges()]
+    max_readings = 5
+
+    def mask(self, readings: TankChanges) -> np.ndarray:
+        return np.full(len(readings), len(readings) <= self.max_readings)
 
 
 @EliminateFalseReadings.register
 class FillReadings(FalseReadingStrategy):
-    def eliminate(self, readings: List[TankChanges]):
-        valid_readings = []
-        for reading in readings:
-            if reading.start_level is None:
-                continue
-            if reading.end_level is None:
-                continue
-            if reading.start_level > reading.end_level:
-                valid_readings.append(reading)
-        if not valid_readings:
-            valid_readings.append(TankChanges())
-        return valid_readings
+    def mask(self, readings: TankChanges) -> np.ndarray:
+        return readings.start_level > readings.end_level
 
 
 @EliminateFalseReadings.register
 class NotEnoughLevelChange(FalseReadingStrategy):
     min_level_change = 3
 
-    def eliminate(self, readings: List[TankChanges]):
-        valid_readings = []
-        for reading in readings:
-            if reading.start_level is None:
-                continue
-            if reading.end_level is None:
-                continue
-            if (reading.start_level - reading.end_level) >= self.min_level_change:
-                valid_readings.append(reading)
-        if not valid_readings:
-            valid_readings.append(TankChanges())
-        return valid_readings
+    def mask(self, readings: TankChanges) -> np.ndarray:
+        return readings.volume_differnce > self.min_level_change
 
 
-@EliminateFalseReadings.register
 class TimesNotAligned(FalseReadingStrategy):
-    def eliminate(self, readings: List[TankChanges]):
-        valid_readings = []
-        for reading in readings:
-            if reading.start_time is None:
-                continue
-            if reading.end_time is None:
-                continue
-            if reading.end_time > reading.start_time:
-                valid_readings.append(reading)
-        if not valid_readings:
-            valid_readings.append(TankChanges())
-        return valid_readings
+    def mask(self, readings: TankChanges) -> np.ndarray:
+        return readings.end_time > readings.start_time
 
 
-@EliminateFalseReadings.register
 class HighNoise(FalseReadingStrategy):
     mean_md = 0.2
     std_md = 0.1
 
-    def eliminate(self, readings: List[TankChanges]) -> List[TankChanges]:
-        valid_readings = []
-        if not readings:
-            return [TankChanges()]
-        for reading in readings:
-
-            if (reading.foward_md is not None) and (
-                reading.foward_md > (mean_md + std_md)
-            ):
-                valid_readings.append(reading)
-        if not valid_readings:
-            valid_readings.append(TankChanges)
-        return valid_readings
+    def mask(self, readings: TankChanges) -> np.ndarray:
+        return readings.forward_md > (self.mean_md + self.std_md)
 
 
 def level_diff(fwd_level, bkwd_level):
-    if fwd_level > bkwd_level:
-        fill_amount = fwd_level - bkwd_level
-    else:
-        fill_amount = 0
-    return fill_amount
+    return np.where(fwd_level > bkwd_level, fwd_level - bkwd_level, 0)
 
 
-def peak_locations(data, column_1, column_2):
+def peak_locations(data, column):
+    values = data[column].values
     peaks, _ = find_peaks(
-        data[column_1], height=(0.8, 40), prominence=0.8, distance=15, width=(1.2, 10)
+        values, height=(0.8, 40), prominence=0.8, distance=15, width=(1.2, 10)
     )
-    widths = peak_widths(data[column_1], peaks)
-    all_peaks = []
-    peak_times = []
-    for i, j in zip(peaks, widths[0]):
-        if j < 10:
-            peak = data.loc[data[column_2] == i][column_1].values[0]
-            when = data.loc[data[column_2] == i].index
-
-            all_peaks.append(peak)
-            peak_times.append(when[0])
-    return all_peaks, peak_times
+    widths = peak_widths(values, peaks)[0]
+    peaks = peaks[widths < 10]
+    return values[peaks], data.index[peaks]
 
 
 def first_peak_minimum(data, column, peak_times, direction=None):
-    all_mins = []
-    min_locs = []
-
-    for i in peak_times:
-        current_row = data.loc[i::direction, column].items()
-        next_row = iter(data.loc[i::direction, column].items())
-        next(next_row)
-        for (curr_index, curr_value), (next_index, next_value) in zip(
-            current_row, next_row
-        ):
-            if curr_value < 1:
-                try:
-                    if curr_value <= next_value and curr_value < 0.1:
-                        md_min = curr_value
-                        min_idx = curr_index
-                        all_mins.append(md_min)
-                        min_locs.append(min_idx)
-                        break
-                except KeyError:
-                    continue
-    return all_mins, min_locs
+    values = data[column].values
+    positions = data.index.get_indexer(peak_times)
+    below = values < 0.1
+    if direction == -1:
+        # walking backward the next value is the one before
+        candidates = np.flatnonzero(below[1:] & (values[1:] <= values[:-1])) + 1
+        found = np.searchsorted(candidates, positions, side="right") - 1
+        valid = found >= 0
+    else:
+        candidates = np.flatnonzero(below[:-1] & (values[:-1] <= values[1:]))
+        found = np.searchsorted(candidates, positions, side="left")
+        valid = found < len(candidates)
+    min_positions = candidates[found[valid]]
+    return values[min_positions], data.index[min_positions]
 
 
 def find_tank_levels(data, column_2, column_3, peak_min_times):
-    levels = []
-    row_nums = []
-    for i in peak_min_times:
-        levels.append(data.loc[i, column_3])
-        row_nums.append(data.loc[i, column_2])
-    return levels, row_nums
+    positions = data.index.get_indexer(peak_min_times)
+    return data[column_3].values[positions], data[column_2].values[positions]
 
 
-def make_values_dict(peak, peak_time, peak_min, peak_min_time, level, row_num):
-    values_dict = {}
-    values_dict["peak"] = peak
-    values_dict["peak_time"] = peak_time
-    values_dict["peak_min"] = peak_min
-    values_dict["peak_min_time"] = peak_min_time
-    values_dict["level"] = level
-    values_dict["row_num"] = row_num
-    return values_dict
-
-
-def find_md_stuff(data, column_1, column_2, column_3, direction=None):
-    peaks, peak_times = peak_locations(data, column_1, column_2)
+def find_md_stuff(data, column_1, column_2, column_3, direction=None) -> dict:
+    peaks, peak_times = peak_locations(data, column_1)
 
     peak_mins, peak_min_times = first_peak_minimum(
         data, column_1, peak_times, direction
@@ -206,138 +174,49 @@ def find_md_stuff(data, column_1, column_2, column_3, direction=None):
 
     levels, row_nums = find_tank_levels(data, column_2, column_3, peak_min_times)
 
-    all_values = []
-    for values in zip(peaks, peak_times, peak_mins, peak_min_times, levels, row_nums):
-        value_dict = make_values_dict(
-            values[0], values[1], values[2], values[3], values[4], values[5]
-        )
-        all_values.append(value_dict)
-
-    return all_values
-
-
-def eliminate_false_readings(
-    fwd_values, bkwd_values
-):  
-    valid_fwd_values = []
-    valid_bkwd_values = []
-    for i, j in zip(fwd_values, bkwd_values):
-        if i["level"] > j["level"] and (i["level"] - j["level"]) > 3:
-            valid_fwd_values.append(i)
-            valid_bkwd_values.append(j)
-
-    if valid_fwd_values == [] and valid_bkwd_values == []:
-        valid_fwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-        valid_bkwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-        return valid_fwd_values, valid_bkwd_values
-
-    if (
-        valid_bkwd_values[0]["peak_min_time"]
-        <= valid_fwd_values[0]["peak_min_time"] - pd.Timedelta(20, "min")
-        and valid_fwd_values[0]["peak_min_time"] < valid_bkwd_values[0]["peak_min_time"]
-    ):
-        valid_fwd_values = valid_fwd_values
-        valid_bkwd_values = valid_bkwd_values
+    n = len(peak_mins)
+    return {
+        "peak": peaks[:n],
+        "peak_time": peak_times[:n],
+        "peak_min": peak_mins,
+        "peak_min_time": peak_min_times,
+        "level": levels,
+        "row_num": row_nums,
+    }
 
-    return valid_fwd_values, valid_bkwd_values
 
+def eliminate_false_readings(changes: TankChanges) -> TankChanges:
+    return EliminateFalseReadings().eliminate(changes)
 
-def infer_fill_and_drain(data, shift_start: dt.datetime, shift_end: dt.datetime):
-    fwd_filtered_data, fwd_mds = infer_tank_level(data.tank_volume)
-    bkwd_filtered_data, bkwd_mds = infer_tank_level(data.tank_volume[::-1])
 
-    fwd_est = []
-    for i in fwd_filtered_data:
-        fwd_est.append(i[0][0])
-    data["filtered_vol_fwd"] = fwd_est
+def infer_fill_and_drain(data, shift_start: dt.datetime, shift_end: dt.datetime):
+    fwd_filtered_data, fwd_mds, _ = infer_tank_level(data.tank_volume)
+    bkwd_filtered_data, bkwd_mds, _ = infer_tank_level(data.tank_volume[::-1])
+    bkwd_filtered_data, bkwd_mds = bkwd_filtered_data[::-1], bkwd_mds[::-1]
 
-    bkwd_est = []
-    for i in bkwd_filtered_data:
-        bkwd_est.append(i[0][0])
-    data["filtered_vol_bkwd"] = bkwd_est[::-1]
+    data["filtered_vol_fwd"] = fwd_filtered_data[:, 0]
+    data["filtered_vol_bkwd"] = bkwd_filtered_data[:, 0]
 
     data["infer_dff"] = data.filtered_vol_bkwd - data.filtered_vol_fwd
     data["fwd_mds"] = fwd_mds
-    data["bkwd_mds"] = bkwd_mds[::-1]
+    data["bkwd_mds"] = bkwd_mds
 
     data = data.loc[shift_start:shift_end]
-    data["row_num"] = list(range(0, len(data)))
+    data["row_num"] = np.arange(len(data))
 
     fwd_values = find_md_stuff(data, "fwd_mds", "row_num", "filtered_vol_fwd", -1)
     bkwd_values = find_md_stuff(data, "bkwd_mds", "row_num", "filtered_vol_bkwd")
 
-    if len(fwd_values) == 0 or len(bkwd_values) == 0:
-        fwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-        bkwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-    elif len(fwd_values) > 5 or len(bkwd_values) > 5:
-        fwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-        bkwd_values = [
-            {
-                "peak": 0,
-                "peak_time": 0,
-                "peak_min": 0,
-                "peak_min_time": 0,
-                "level": 0,
-                "row_num": 0,
-            }
-        ]
-
-    valid_fwd_values, valid_bkwd_values = eliminate_false_readings(
-        fwd_values, bkwd_values
-    )
-    return valid_fwd_values, valid_bkwd_values, data["inlet_flowrate"].sum()
-
+    counts = len(fwd_values["level"]), len(bkwd_values["level"])
+    if min(counts) == 0 or max(counts) > TooMany.max_readings:
+        changes = TankChanges()
+    else:
+        changes = eliminate_false_readings(
+            TankChanges.from_md_values(fwd_values, bkwd_values)
+        )
+    return changes, data["inlet_flowrate"].sum()
 
-def calculate_chemical_usage(valid_fwd_values, valid_bkwd_values):
-    spent_vol = []
-    for values in zip(valid_fwd_values, valid_bkwd_values):
-        vol_diff = round(level_diff(values[0]["level"], values[1]["level"]), 2)
-        spent_vol.append(vol_diff)
-    chem_spent = sum(spent_vol)
 
-    return chem_spent
+def calculate_chemical_usage(changes: TankChanges):
+    spent_vol = np.round(level_diff(changes.start_level, changes.end_level), 2)
+    return float(spent_vol.sum())
@@ -1,70 +1,498 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple
+from __future__ import annotations
+
+import datetime as dt
+import json
+import math
+import re
+
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 
-from filterpy.common import Q_discrete_white_noise
-from filterpy.kalman import KalmanFilter
 
+@dataclass
+class FilterState:
+    """Checkpoint of a Kalman filter after its last reading.
+
+    Passing it back into the filter with the readings that follow gives the
+    same numbers as running the filter over the whole window.
+    """
+
+    x: List[float]
+    P: List[List[float]]
+    timestamp: dt.datetime
+    control: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        values = asdict(self)
+        values["timestamp"] = self.timestamp.isoformat()
+        return values
+
+    @classmethod
+    def from_dict(cls, values: dict) -> FilterState:
+        values = dict(values)
+        values["timestamp"] = dt.datetime.fromisoformat(values["timestamp"])
+        return cls(**values)
+
+
+class FilterStates:
+    """Filter checkpoints saved per tag as json files in a folder.
+
+    Example:
+        >>> states = FilterStates("checkpoints")
+        >>> xs, mds, states[tag] = infer_tank_level(data, states.get(tag))
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def path(self, tag: str) -> Path:
+        return self.folder / (re.sub(r"[^\w.-]", "_", tag) + ".json")
+
+    def __getitem__(self, tag: str) -> FilterState:
+        try:
+            with self.path(tag).open() as f:
+                return FilterState.from_dict(json.load(f))
+        except FileNotFoundError as err:
+            raise KeyError(tag) from err
+
+    def __setitem__(self, tag: str, state: FilterState):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with self.path(tag).open("w") as f:
+            json.dump(state.to_dict(), f)
+
+    def __contains__(self, tag: str) -> bool:
+        return self.path(tag).exists()
+
+    def get(self, tag: str, default: Optional[FilterState] = None):
+        try:
+            return self[tag]
+        except KeyError:
+            return default
+
+
+PROD_RATE_F = np.array([[1.0, -1, 1], [0, 1, 0], [0, 0, 1]])
+PROD_RATE_H = np.array([[1.0, 0, 0], [0, 1, 0]])
+PROD_RATE_Q = np.array([[100.0, -1, 1], [-1, 1, 0], [1, 0, 1]])
+PROD_RATE_R = np.array([[100.0, 0], [0, 1]])
 
-def measurement_noise(data):
-    return [np.array([[100, 0], [0, 1]]) for _ in range(len(data))]
 
+def prod_rate_gains(
+    p0: np.ndarray,
+    r: np.ndarray = PROD_RATE_R,
+    tol: float = 1e-12,
+    max_steps: int = 10000,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Kalman and smoother gains of the production rate filter.
 
-def process_control(data):
-    us = [None] * len(data)
-    dpumprate = zip(data.itertuples(), data.shift().itertuples())
-    next(dpumprate)
-    for i, (current_row, prev_row) in enumerate(dpumprate, 1):
-        us[i] = np.array(
-            [0, current_row.product_flowrate - prev_row.product_flowrate, 0]
-        ).reshape(-1, 1)
-    return us
+    With constant F, Q and R the covariances do not depend on the readings,
+    so the gains are computed up front and stop once they reach steady state.
 
+    Params:
+        p0: covariance before the first reading
+        r: measurement noise covariance shared by every reading
+        tol: relative change of the covariance treated as steady state
+        max_steps: most steps computed before settling for the last gain
 
-def infer_prod_rate(data):
-    kf = KalmanFilter(dim_x=3, dim_z=2, dim_u=1)
-    kf.x = np.array(
-        [
+    Returns:
+        ks: kalman gains, shape (m, 3, 2)
+        cs: smoother gains, shape (m, 3, 3)
+        ps: posterior covariances, shape (m, 3, 3)
+        the last entry of each applies to every step from m - 1 on
+    """
+    F, H, Q = PROD_RATE_F, PROD_RATE_H, PROD_RATE_Q
+    I = np.eye(3)
+    ks, cs, ps = [], [], []
+    P = np.asarray(p0, dtype=float)
+    for _ in range(max_steps):
+        Pp = F @ P @ F.T + Q
+        K = Pp @ H.T @ np.linalg.inv(H @ Pp @ H.T + r)
+        A = I - K @ H
+        P_next = A @ Pp @ A.T + K @ r @ K.T
+        steady = bool(ps) and np.abs(P_next - P).max() <= tol * np.abs(P).max()
+        P = P_next
+        ks.append(K)
+        cs.append(P @ F.T @ np.linalg.inv(F @ P @ F.T + Q))
+        ps.append(P)
+        if steady:
+            break
+    return np.array(ks), np.array(cs), np.array(ps)
+
+
+@lru_cache(maxsize=None)
+def initial_prod_rate_gains() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """prod_rate_gains of a fresh filter starting from P = 500 * I."""
+    return prod_rate_gains(np.eye(3) * 500)
+
+
+def prod_rate_kernel(
+    zs: np.ndarray,
+    us: np.ndarray,
+    x0: Sequence[float],
+    gains: Tuple[np.ndarray, np.ndarray, np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Production rate filter and RTS smoother over preallocated arrays.
+
+    The state is [tank volume, product flowrate, fill rate] with
+    F = [[1, -1, 1], [0, 1, 0], [0, 0, 1]] and the change in flowrate as
+    the control input on the flowrate.
+
+    Params:
+        zs: tank volume and flowrate readings, shape (n, 2)
+        us: change in flowrate since the previous reading, shape (n,)
+        x0: state before the first reading
+        gains: ks, cs and ps from prod_rate_gains
+
+    Returns:
+        xs: filtered states, shape (n, 3)
+        smoothed_xs: smoothed states, shape (n, 3)
+    """
+    ks, cs, _ = gains
+    last = len(ks) - 1
+    ks = ks.tolist()
+    cs = cs.tolist()
+    n = len(zs)
+    xs = np.empty((n, 3))
+    smoothed_xs = np.empty((n, 3))
+    if n == 0:
+        return xs, smoothed_xs
+
+    volume, flowrate, fill_rate = map(float, x0)
+    for i, ((z_volume, z_flowrate), u) in enumerate(zip(zs.tolist(), us.tolist())):
+        (k00, k01), (k10, k11), (k20, k21) = ks[min(i, last)]
+        volume = volume - flowrate + fill_rate
+        flowrate = flowrate + u
+        y0 = z_volume - volume
+        y1 = z_flowrate - flowrate
+        volume += k00 * y0 + k01 * y1
+        flowrate += k10 * y0 + k11 * y1
+        fill_rate += k20 * y0 + k21 * y1
+        xs[i] = volume, flowrate, fill_rate
+
+    smoothed_xs[-1] = xs[-1]
+    s_volume, s_flowrate, s_fill_rate = xs[-1].tolist()
+    for i in range(n - 2, -1, -1):
+        (c00, c01, c02), (c10, c11, c12), (c20, c21, c22) = cs[min(i, last)]
+        volume, flowrate, fill_rate = xs[i].tolist()
+        # the smoother predicts without the control input, like filterpy
+        d0 = s_volume - (volume - flowrate + fill_rate)
+        d1 = s_flowrate - flowrate
+        d2 = s_fill_rate - fill_rate
+        s_volume = volume + c00 * d0 + c01 * d1 + c02 * d2
+        s_flowrate = flowrate + c10 * d0 + c11 * d1 + c12 * d2
+        s_fill_rate = fill_rate + c20 * d0 + c21 * d1 + c22 * d2
+        smoothed_xs[i] = s_volume, s_flowrate, s_fill_rate
+    return xs, smoothed_xs
+
+
+def infer_prod_rate(
+    data, state: Optional[FilterState] = None
+) -> Tuple[np.ndarray, Optional[FilterState]]:
+    """Smooth product tank volume, flowrate and fill rate.
+
+    Params:
+        data: product_tank_volume and product_flowrate indexed by datetime
+        state: checkpoint returned by a previous call, readings at or
+            before its timestamp are skipped
+
+    Returns:
+        x: smoothed [volume, flowrate, fill rate], shape (n, 3)
+        state: checkpoint after the last reading
+    """
+    if state is None:
+        x0 = [
             data.product_tank_volume.iloc[0],
             data.product_flowrate.iloc[0],
             data.product_flowrate.sum() / 1440,
         ]
-    ).reshape(-1, 1)
-    kf.F = np.array([[1, -1, 1], [0, 1, 0], [0, 0, 1]])
-    kf.B = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]])
-    kf.H = np.array([[1, 0, 0], [0, 1, 0]])
-    kf.P *= 500
-    kf.Q = np.array([[100, -1, 1], [-1, 1, 0], [1, 0, 1]])
-    rs = measurement_noise(data)
-    us = process_control(data)
-    zs = data[["product_tank_volume", "product_flowrate"]].values.reshape(-1, 2, 1)
-    mu, cov, _, _ = kf.batch_filter(zs=zs, Rs=rs, us=us)
-    x, _, _, _ = kf.rts_smoother(mu, cov)
-    return x
-
-
-def infer_tank_level(data: pd.Series) -> Tuple[np.ndarray, float]:
-    kf = KalmanFilter(dim_x=2, dim_z=1)
-    kf.H = np.array([[1, 0]])
-    kf.P *= 500
-    kf.R = 100
-    xs = []
-    mds = []
-    current_records = data.iteritems()
-    next_records = data.iteritems()
-    init_ts, init_reading = next(next_records)
-    kf.x = np.array([init_reading, 0]).reshape(-1, 1)
-    xs.append(np.copy(kf.x))
-    mds.append(0)
-    for (c_ts, c_level), (n_ts, n_level) in zip(current_records, next_records):
-        dt = (n_ts - c_ts).total_seconds() / 60
-
-        kf.F = np.array([[1, dt], [0, 1]])
-        kf.Q = Q_discrete_white_noise(dim=2, dt=dt, var=0.01)
-        kf.predict()
-        kf.update(n_level)
-        xs.append(np.copy(kf.x))
-        mds.append(kf.mahalanobis)
+        gains = initial_prod_rate_gains()
+        previous_flowrate = data.product_flowrate.iloc[0]
+    else:
+        data = data.loc[data.index > state.timestamp]
+        if len(data) == 0:
+            return np.empty((0, 3)), state
+        x0 = state.x
+        gains = prod_rate_gains(state.P)
+        previous_flowrate = state.control
+    flowrate = data.product_flowrate.values.astype(float)
+    us = np.diff(flowrate, prepend=previous_flowrate)
+    zs = data[["product_tank_volume", "product_flowrate"]].values.astype(float)
+    xs, smoothed_xs = prod_rate_kernel(zs, us, x0, gains)
+    ps = gains[2]
+    state = FilterState(
+        xs[-1].tolist(),
+        ps[min(len(xs), len(ps)) - 1].tolist(),
+        data.index[-1].to_pydatetime(),
+        float(flowrate[-1]),
+    )
+    return smoothed_xs, state
+
+
+def product_calculations(data):
+    filtered_measurements, _ = infer_prod_rate(data)
+    infered_fillrate = filtered_measurements[:, 2]
+    scfm = (data.inlet_flowrate * 1000) / 1440
+    per_inlet_values = infered_fillrate / scfm
+    per_inlet_values[per_inlet_values < 0] = 0
+    per_inlet_values[per_inlet_values == np.inf] = 0
+
+    cumulative_values = np.cumsum(np.maximum(infered_fillrate, 0))
+    return per_inlet_values, cumulative_values
+
+
+def minute_steps(index: pd.Index) -> np.ndarray:
+    """Signed number of minutes between consecutive timestamps."""
+    return np.diff(index.values) / np.timedelta64(1, "m")
+
+
+def tank_level_kernel(
+    zs: np.ndarray,
+    dts: np.ndarray,
+    var: float = 0.01,
+    r: float = 100,
+    ps: Optional[np.ndarray] = None,
+    x0: Optional[Sequence[float]] = None,
+    p0: Optional[Sequence[float]] = None,
+    skip_missing: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Constant velocity Kalman filter over a single tank level series.
+
+    Params:
+        zs: tank level readings, shape (n,)
+        dts: minutes between readings, shape (n - 1,)
+            or shape (n,) when resuming from x0
+        var: process noise variance of the white noise model
+        r: measurement noise variance
+        ps: optional array of shape (n, 3) the posterior covariances
+            [p00, p01, p11] are written into
+        x0: [level, rate] to resume from, the first reading is then
+            predicted and updated like every other one
+        p0: [p00, p01, p11] covariance to resume from
+        skip_missing: only predict at missing (NaN) readings, their
+            mahalanobis distance is NaN
+
+    Returns:
+        xs: filtered [level, rate] for every reading, shape (n, 2)
+        mds: mahalanobis distance of every update, shape (n,)
+    """
+    zs = np.asarray(zs, dtype=float)
+    dts = np.asarray(dts, dtype=float)
+    n = len(zs)
+    xs = np.empty((n, 2))
+    mds = np.empty(n)
+    if n == 0:
+        return xs, mds
+
+    if x0 is None:
+        level, rate = float(zs[0]), 0.0
+        p00, p01, p11 = 500.0, 0.0, 500.0
+        xs[0] = level, rate
+        mds[0] = 0
+        if ps is not None:
+            ps[0] = p00, p01, p11
+        start = 1
+    else:
+        level, rate = map(float, x0)
+        p00, p01, p11 = map(float, p0)
+        start = 0
+    for i, (z, dt) in enumerate(zip(zs[start:].tolist(), dts.tolist()), start):
+        # predict: F = [[1, dt], [0, 1]], Q = Q_discrete_white_noise(2, dt, var)
+        q11 = var * dt * dt
+        level += dt * rate
+        p00 += dt * (2 * p01 + dt * p11) + q11 * dt * dt / 4
+        p01 += dt * p11 + q11 * dt / 2
+        p11 += q11
+        if skip_missing and z != z:
+            xs[i] = level, rate
+            mds[i] = math.nan
+            if ps is not None:
+                ps[i] = p00, p01, p11
+            continue
+        # update with H = [1, 0] and the Joseph form covariance
+        y = z - level
+        s = p00 + r
+        k0 = p00 / s
+        k1 = p01 / s
+        level += k0 * y
+        rate += k1 * y
+        a = 1 - k0
+        p00, p01, p11 = (
+            a * a * p00 + r * k0 * k0,
+            a * (p01 - k1 * p00) + r * k0 * k1,
+            k1 * k1 * p00 - 2 * k1 * p01 + p11 + r * k1 * k1,
+        )
+        xs[i] = level, rate
+        mds[i] = math.sqrt(y * y / s)
+        if ps is not None:
+            ps[i] = p00, p01, p11
+    return xs, mds
+
+
+def infer_tank_level(
+    data: pd.Series, state: Optional[FilterState] = None
+) -> Tuple[np.ndarray, np.ndarray, Optional[FilterState]]:
+    """Filter a tank level series.
+
+    Params:
+        data: tank levels indexed by datetime
+        state: checkpoint returned by a previous call, readings at or
+            before its timestamp are skipped
+
+    Returns:
+        xs: filtered [level, rate], shape (n, 2)
+        mds: mahalanobis distances, shape (n,)
+        state: checkpoint after the last reading
+    """
+    if state is None:
+        ps = np.empty((len(data), 3))
+        xs, mds = tank_level_kernel(data.values, minute_steps(data.index), ps=ps)
+    else:
+        data = data.loc[data.index > state.timestamp]
+        ps = np.empty((len(data), 3))
+        dts = minute_steps(data.index.insert(0, state.timestamp))
+        (p00, p01), (_, p11) = state.P
+        xs, mds = tank_level_kernel(
+            data.values, dts, ps=ps, x0=state.x, p0=(p00, p01, p11)
+        )
+    if len(data) == 0:
+        return xs, mds, state
+
+    (p00, p01, p11) = ps[-1].tolist()
+    state = FilterState(
+        xs[-1].tolist(),
+        [[p00, p01], [p01, p11]],
+        data.index[-1].to_pydatetime(),
+    )
+    return xs, mds, state
+
+
+# below this many tanks a loop over tank_level_kernel is quicker than
+# broadcasting every step over the tank axis
+BATCH_MIN_TANKS = 24
+
+
+def batch_tank_level_kernel(
+    zs: np.ndarray, dts: np.ndarray, var: float = 0.01, r: float = 100
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Constant velocity Kalman filter over many aligned tank level series.
+
+    Missing readings (NaN) are masked out: a tank starts filtering at its
+    first valid reading and only runs the predict step while its readings
+    are missing. From BATCH_MIN_TANKS tanks on, like a whole division's,
+    every step is broadcast over the tank axis. Fewer tanks, like one
+    site's, are filtered one at a time, which is quicker for them.
+
+    Params:
+        zs: tank level readings, shape (n, tanks)
+        dts: minutes between rows, shape (n - 1,)
+        var: process noise variance of the white noise model
+        r: measurement noise variance
+
+    Returns:
+        xs: filtered [level, rate] per row and tank, shape (n, tanks, 2)
+            NaN before a tank's first valid reading
+        mds: mahalanobis distance per row and tank, shape (n, tanks)
+            NaN where the reading is missing
+    """
+    zs = np.asarray(zs, dtype=float)
+    dts = np.asarray(dts, dtype=float)
+    n, m = zs.shape
+    if m >= BATCH_MIN_TANKS:
+        return broadcast_tank_level_kernel(zs, dts, var, r)
+
+    xs = np.full((n, m, 2), np.nan)
+    mds = np.full((n, m), np.nan)
+    valid = ~np.isnan(zs)
+    for tank in range(m):
+        readings = np.flatnonzero(valid[:, tank])
+        if not len(readings):
+            continue
+        first = readings[0]
+        xs[first:, tank], mds[first:, tank] = tank_level_kernel(
+            zs[first:, tank], dts[first:], var, r, skip_missing=True
+        )
+    return xs, mds
+
+
+def broadcast_tank_level_kernel(
+    zs: np.ndarray, dts: np.ndarray, var: float = 0.01, r: float = 100
+) -> Tuple[np.ndarray, np.ndarray]:
+    """batch_tank_level_kernel with every step broadcast over the tanks.
+
+    Rows where every tank has a reading and has started skip the masking.
+    """
+    n, m = zs.shape
+    xs = np.full((n, m, 2), np.nan)
+    mds = np.full((n, m), np.nan)
+    valid = ~np.isnan(zs)
+    full_rows = valid.all(axis=1)
+
+    started = np.zeros(m, dtype=bool)
+    all_started = False
+    level = np.zeros(m)
+    rate = np.zeros(m)
+    p00 = np.full(m, 500.0)
+    p01 = np.zeros(m)
+    p11 = np.full(m, 500.0)
+    for i in range(n):
+        z = zs[i]
+        if i:
+            dt = dts[i - 1]
+            q11 = var * dt * dt
+            level = level + dt * rate
+            p00 = p00 + dt * (2 * p01 + dt * p11) + q11 * dt * dt / 4
+            p01 = p01 + dt * p11 + q11 * dt / 2
+            p11 = p11 + q11
+
+        y = z - level
+        s = p00 + r
+        k0 = p00 / s
+        k1 = p01 / s
+        a = 1 - k0
+        if all_started and full_rows[i]:
+            level = level + k0 * y
+            rate = rate + k1 * y
+            p00, p01, p11 = (
+                a * a * p00 + r * k0 * k0,
+                a * (p01 - k1 * p00) + r * k0 * k1,
+                k1 * k1 * p00 - 2 * k1 * p01 + p11 + r * k1 * k1,
+            )
+            mds[i] = np.sqrt(y * y / s)
+            xs[i, :, 0] = level
+            xs[i, :, 1] = rate
+            continue
+
+        update = valid[i] & started
+        level = np.where(update, level + k0 * y, level)
+        rate = np.where(update, rate + k1 * y, rate)
+        p00, p01, p11 = (
+            np.where(update, a * a * p00 + r * k0 * k0, p00),
+            np.where(update, a * (p01 - k1 * p00) + r * k0 * k1, p01),
+            np.where(update, k1 * k1 * p00 - 2 * k1 * p01 + p11 + r * k1 * k1, p11),
+        )
+        mds[i] = np.where(update, np.sqrt(y * y / s), np.nan)
+
+        init = valid[i] & ~started
+        if init.any():
+            level[init] = z[init]
+            rate[init] = 0
+            p00[init] = 500
+            p01[init] = 0
+            p11[init] = 500
+            mds[i, init] = 0
+            started |= init
+            all_started = started.all()
+
+        xs[i, started, 0] = level[started]
+        xs[i, started, 1] = rate[started]
     return xs, mds
+
+
+def infer_tank_levels(data: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Filter every tank column of a minute aligned frame in one pass."""
+    return batch_tank_level_kernel(data.values, minute_steps(data.index))
@@ -1,35 +1,228 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import os
+import threading
+import time
 import urllib
 
+from typing import Callable, Dict, Optional
+
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 
-import cx_Oracle
+from tools.utilities.tags import configs
 
 TIMEOUT_SECONDS = 60
 
+POOL_DEFAULTS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30.0,
+    "pool_recycle": float(TIMEOUT_SECONDS),
+    "pool_pre_ping": True,
+    "warm_connections": 0,
+}
+
+
+def layered_settings(defaults: dict, *tables: dict, env_prefix: str) -> dict:
+    """Defaults updated by each config table and then by environment variables.
+
+    Environment variables are named env_prefix and the setting name in upper
+    case, like HISTORY_ENGINE_A_POOL_SIZE, and are cast to the default's type.
+    """
+    settings = dict(defaults)
+    for table in tables:
+        settings.update(table)
+    for name, value in settings.items():
+        env_name = f"{env_prefix}_{name}".upper()
+        env_value = os.getenv(env_name)
+        if env_value is None:
+            continue
+        # config tables may write 30 for a float setting, so go by the default
+        default = defaults.get(name, value)
+        if isinstance(default, bool):
+            settings[name] = env_value.lower() in ("1", "true", "yes")
+            continue
+        try:
+            settings[name] = type(default)(env_value)
+        except ValueError as err:
+            raise ValueError(
+                f"{env_name}={env_value!r} can't be read as {type(default).__name__}"
+            ) from err
+    return settings
+
+
+def pool_settings(key: str) -> dict:
+    """Pool settings of a historian engine.
+
+    Defaults are overridden by the [historian_pools.default] and
+    [historian_pools.<engine name>] tables in config.toml and then by
+    environment variables named like HISTORY_ENGINE_A_POOL_SIZE.
+    """
+    pools = configs.get("historian_pools", {})
+    return layered_settings(
+        POOL_DEFAULTS, pools.get("default", {}), pools.get(key, {}), env_prefix=key
+    )
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that keeps track of how long checkouts wait for a connection.
+
+    Time spent opening new connections is counted apart from the wait.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_lock = threading.Lock()
+        self.local = threading.local()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.connects = 0
+        self.connect_seconds = 0.0
+
+    def _create_connection(self):
+        start = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            took = time.perf_counter() - start
+            self.local.connect_seconds = self.connect_time() + took
+            with self.wait_lock:
+                self.connects += 1
+                self.connect_seconds += took
+
+    def connect_time(self) -> float:
+        return getattr(self.local, "connect_seconds", 0.0)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        connecting = self.connect_time()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start - (self.connect_time() - connecting)
+            with self.wait_lock:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.waits = self.waits
+        pool.wait_seconds = self.wait_seconds
+        pool.max_wait_seconds = self.max_wait_seconds
+        pool.connects = self.connects
+        pool.connect_seconds = self.connect_seconds
+        return pool
+
+
+def historian_engine(key: str, params: str) -> Engine:
+    """Engine for a historian with the pool settings configured for it."""
+    settings = pool_settings(key)
+    settings.pop("warm_connections")
+    return create_engine(
+        f"mssql+pyodbc:///?odbc_connect={params!s}",
+        poolclass=TimedQueuePool,
+        **settings,
+    )
+
+
+def pool_stats(engine: Engine) -> dict:
+    pool = engine.pool
+    stats = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    if isinstance(pool, TimedQueuePool):
+        stats["waits"] = pool.waits
+        stats["wait_seconds"] = pool.wait_seconds
+        stats["max_wait_seconds"] = pool.max_wait_seconds
+        stats["connects"] = pool.connects
+        stats["connect_seconds"] = pool.connect_seconds
+    return stats
+
 
 class Engines:
+    """Registry of engine factories, each engine is built on first access.
+
+    Example:
+        >>> engine = engines("history_engine_a")
+        >>> engines.warm("history_engine_a", "history_engine_b")
+        >>> engines.dispose()
+    """
+
     def __init__(self):
-        self.engines = {}
+        self.factories: Dict[str, Callable[[], Engine]] = {}
+        self.engines: Dict[str, Engine] = {}
+        self.lock = threading.Lock()
+
+    def register(self, key: str, factory: Callable[[], Engine]):
+        self.factories[key] = factory
 
-    def __getitem__(self, key):
-        return self.engines[key]
+    def __getitem__(self, key) -> Engine:
+        try:
+            return self.engines[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key not in self.engines:
+                self.engines[key] = self.factories[key]()
+            return self.engines[key]
 
     def __setitem__(self, key, item):
         self.engines[key] = item
 
-    def __call__(self, arg):
-        return self.engines[arg]
+    def __call__(self, arg) -> Engine:
+        return self[arg]
+
+    def __contains__(self, key) -> bool:
+        return key in self.factories or key in self.engines
+
+    def warm(self, *keys: str, connections: Optional[int] = None):
+        """Build the given engines, or every registered one, right away.
+
+        Params:
+            keys: engine names, every registered engine by default
+            connections: connections to open and return to each pool,
+                the engine's warm_connections setting by default
+        """
+        for key in keys or list(self.factories):
+            engine = self[key]
+            count = connections
+            if count is None:
+                count = pool_settings(key)["warm_connections"]
+            opened = [engine.connect() for _ in range(count)]
+            for connection in opened:
+                connection.close()
+
+    def stats(self, *keys: str) -> Dict[str, dict]:
+        """Pool statistics of the given, or every built, engine."""
+        keys = keys or list(self.engines)
+        return {key: pool_stats(self.engines[key]) for key in keys}
+
+    def dispose(self, *keys: str):
+        """Close the pooled connections of built engines and forget them.
+
+        The next access builds a fresh engine, which is what a forked
+        worker process should do instead of sharing its parent's pool.
+        """
+        with self.lock:
+            for key in keys or list(self.engines):
+                engine = self.engines.pop(key, None)
+                if engine is not None:
+                    engine.dispose()
 
 
 engines = Engines()
 
 
 def new_engine(func):
-    engines[func.__name__] = func()
+    engines.register(func.__name__, func)
     return func
 
 
@@ -47,9 +240,7 @@ def history_engine_a() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_A_NAME.company.com;DATABASE=DATABASE_A;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_a", _params)
 
 
 @new_engine
@@ -66,9 +257,7 @@ def history_engine_b() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_B_NAME.company.com;DATABASE=DATABASE_B;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_b", _params)
 
 
 @new_engine
@@ -85,9 +274,7 @@ def history_engine_c() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_C_NAME.company.com;DATABASE=DATABASE_C;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_c", _params)
 
 
 @new_engine
@@ -104,9 +291,7 @@ def history_engine_d() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_D_NAME.company.com;DATABASE=DATABASE_D;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_d", _params)
 
 
 @new_engine
@@ -123,9 +308,7 @@ def history_engine_e() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_E_NAME.company.com;DATABASE=DATABASE_E;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_e", _params)
 
 
 @new_engine
@@ -142,6 +325,4 @@ def history_engine_f() -> Engine:
         "DRIVER={SQL Server};SERVER=DATABASE_F_NAME.company.com;DATABASE=DATABASE_F;UID=user_name;PWD=password"
     )
 
-    return create_engine(
-        f"mssql+pyodbc:///?odbc_connect={_params!s}", pool_recycle=TIMEOUT_SECONDS
-    )
+    return historian_engine("history_engine_f", _params)
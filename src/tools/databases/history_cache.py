@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import datetime as dt
+import os
+import re
+import tempfile
+import threading
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import pandas as pd
+
+from tools.databases.connections import layered_settings
+from tools.utilities.tags import configs
+
+CACHE_DEFAULTS = {
+    "enabled": False,
+    "folder": "",
+    "max_gb": 5.0,
+    "fresh_hours": 6.0,
+}
+
+DEFAULT_FOLDER = Path.home() / ".data_tools" / "history_cache"
+
+
+def cache_settings() -> dict:
+    """Settings of the historian cache.
+
+    Defaults are overridden by the [history_cache] table in config.toml and
+    then by environment variables named like HISTORY_CACHE_MAX_GB.
+    """
+    return layered_settings(
+        CACHE_DEFAULTS, configs.get("history_cache", {}), env_prefix="history_cache"
+    )
+
+
+@dataclass(frozen=True)
+class Connection:
+    """How a connection's query_analog_data names, orders and cuts columns."""
+
+    column: Callable[[str], str]
+    includes_end: bool
+    drops_incomplete: bool
+    # pivoted results come back sorted by column instead of in tag order
+    sorts_columns: bool
+
+
+CONNECTIONS = {
+    "connection_1": Connection(
+        column=lambda tag: tag.split(":")[-1].lower(),
+        includes_end=True,
+        drops_incomplete=True,
+        sorts_columns=False,
+    ),
+    "connection_2": Connection(
+        column=lambda tag: tag.lower(),
+        includes_end=False,
+        drops_incomplete=False,
+        sorts_columns=True,
+    ),
+}
+
+DAY = dt.timedelta(days=1)
+
+
+def day_range(start: dt.datetime, end: dt.datetime) -> List[dt.datetime]:
+    """Midnights of every day the window touches."""
+    first = pd.Timestamp(start).floor("D")
+    return list(pd.date_range(first, end, freq="D").to_pydatetime())
+
+
+def day_runs(days: List[dt.datetime]) -> Iterator[Tuple[dt.datetime, dt.datetime]]:
+    """Group sorted days into (first day, day after the last) runs."""
+    run_start = run_end = None
+    for day in days:
+        if run_end is not None and day == run_end:
+            run_end = day + DAY
+            continue
+        if run_start is not None:
+            yield run_start, run_end
+        run_start, run_end = day, day + DAY
+    if run_start is not None:
+        yield run_start, run_end
+
+
+class HistoryCache:
+    """Parquet copy of a connection's minute data, one file per tag and day.
+
+    Calls look like query_analog_data. Only the tag days missing from the
+    cache are queried from the historian. A day is only final once it was
+    fetched fresh_horizon after it ended, until then it is fetched again on
+    every call. Least recently read files are deleted once the cache is
+    bigger than max_bytes.
+
+    Example:
+        >>> query_data = HistoryCache("connection_2", query_analog_data, folder)
+        >>> data = query_data("location_a", tags, start_date, end_date, 60)
+    """
+
+    def __init__(
+        self,
+        connection_type: str,
+        query_data: Callable[..., pd.DataFrame],
+        folder: Path,
+        max_bytes: int = int(CACHE_DEFAULTS["max_gb"] * 2 ** 30),
+        fresh_horizon: dt.timedelta = dt.timedelta(hours=CACHE_DEFAULTS["fresh_hours"]),
+    ):
+        self.connection_type = connection_type
+        self.connection = CONNECTIONS[connection_type]
+        self.query_data = query_data
+        self.folder = Path(folder) / connection_type
+        self.max_bytes = max_bytes
+        self.fresh_horizon = fresh_horizon
+        self.lock = threading.Lock()
+        # size of the cache folder, walked once and then kept up to date
+        self.nbytes = None
+
+    def partition(
+        self, which: str, tag: str, sample_freq: float, day: dt.datetime
+    ) -> Path:
+        tag_folder = re.sub(r"[^\w.-]", "_", tag)
+        return (
+            self.folder
+            / which
+            / f"{sample_freq}s"
+            / tag_folder
+            / f"{day:%Y-%m-%d}.parquet"
+        )
+
+    def is_final(self, path: Path, day: dt.datetime) -> bool:
+        if not path.exists():
+            return False
+        fetched = dt.datetime.fromtimestamp(path.stat().st_mtime)
+        return fetched >= day + DAY + self.fresh_horizon
+
+    def missing_runs(
+        self, which: str, tags: List[str], sample_freq: float, days: List[dt.datetime]
+    ) -> Dict[Tuple[dt.datetime, dt.datetime], List[str]]:
+        """Runs of days to fetch, each with the tags missing exactly those days."""
+        runs = {}
+        for tag in tags:
+            tag_days = [
+                day
+                for day in days
+                if not self.is_final(self.partition(which, tag, sample_freq, day), day)
+            ]
+            for run in day_runs(tag_days):
+                runs.setdefault(run, []).append(tag)
+        return runs
+
+    def fetch(
+        self,
+        which: str,
+        tags: List[str],
+        run_start: dt.datetime,
+        run_end: dt.datetime,
+        sample_freq: float,
+    ):
+        """Query the days [run_start, run_end) and write a file per tag and day."""
+        if self.connection.drops_incomplete:
+            # one tag's gaps would drop the rows of every other tag, query alone
+            for tag in tags:
+                self.fetch_together(which, [tag], run_start, run_end, sample_freq)
+        else:
+            self.fetch_together(which, tags, run_start, run_end, sample_freq)
+
+    def fetch_together(
+        self,
+        which: str,
+        tags: List[str],
+        run_start: dt.datetime,
+        run_end: dt.datetime,
+        sample_freq: float,
+    ):
+        # one minute early so the first midnight is inside every connection's window
+        data = self.query_data(
+            which, tags, run_start - dt.timedelta(minutes=1), run_end, sample_freq
+        )
+        data = data[(data.index >= run_start) & (data.index < run_end)]
+        for tag in tags:
+            column = self.connection.column(tag)
+            if column in data:
+                values = data[[column]].rename(columns={column: "value"})
+            else:
+                values = pd.DataFrame({"value": []}, index=pd.DatetimeIndex([]))
+            values.index.name = "datetime"
+            for day in pd.date_range(run_start, run_end - DAY, freq="D"):
+                self.write(
+                    self.partition(which, tag, sample_freq, day),
+                    values[(values.index >= day) & (values.index < day + DAY)],
+                )
+
+    def write(self, path: Path, values: pd.DataFrame):
+        """Replace path with values, readers only ever see a whole file."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # a temp file per call, threads of one process share the pid
+        handle, temp = tempfile.mkstemp(suffix=".tmp", dir=path.parent)
+        os.close(handle)
+        try:
+            values.to_parquet(temp)
+            written = os.path.getsize(temp)
+            replaced = path.stat().st_size if path.exists() else 0
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+        with self.lock:
+            if self.nbytes is not None:
+                self.nbytes += written - replaced
+
+    def read(
+        self, which: str, tag: str, sample_freq: float, days: List[dt.datetime]
+    ) -> pd.Series:
+        frames = []
+        for day in days:
+            path = self.partition(which, tag, sample_freq, day)
+            frames.append(pd.read_parquet(path))
+            # the access time orders eviction, the modified time is kept for is_final
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        values = pd.concat(frames)["value"]
+        return values.rename(self.connection.column(tag))
+
+    def cache_bytes(self) -> int:
+        with self.lock:
+            if self.nbytes is None:
+                self.nbytes = sum(
+                    path.stat().st_size for path in self.folder.rglob("*.parquet")
+                )
+            return self.nbytes
+
+    def evict(self):
+        """Delete the least recently read files until the cache fits max_bytes."""
+        if self.cache_bytes() <= self.max_bytes:
+            return
+        with self.lock:
+            files = [(path, path.stat()) for path in self.folder.rglob("*.parquet")]
+            # other processes may share the folder, so count it again here
+            total = sum(stat.st_size for _, stat in files)
+            for path, stat in sorted(files, key=lambda item: item[1].st_atime):
+                if total <= self.max_bytes:
+                    break
+                path.unlink()
+                total -= stat.st_size
+            self.nbytes = total
+
+    def __call__(
+        self,
+        which: str,
+        tags: List[str],
+        start_date: dt.datetime,
+        end_date: dt.datetime,
+        sample_freq: float = 1,
+    ) -> pd.DataFrame:
+        if isinstance(tags, str):
+            tags = [tags]
+        days = day_range(start_date, end_date)
+        runs = self.missing_runs(which, tags, sample_freq, days)
+        for (run_start, run_end), run_tags in runs.items():
+            self.fetch(which, run_tags, run_start, run_end, sample_freq)
+
+        data = pd.concat(
+            [self.read(which, tag, sample_freq, days) for tag in tags], axis=1
+        )
+        if runs:
+            self.evict()
+        if self.connection.sorts_columns:
+            data = data.sort_index(axis=1)
+        data.columns.name = "tagname"
+        if self.connection.includes_end:
+            in_window = (data.index > start_date) & (data.index <= end_date)
+        else:
+            in_window = (data.index > start_date) & (data.index < end_date)
+        data = data[in_window]
+        if self.connection.drops_incomplete:
+            data = data.dropna(how="any")
+        return data
+
+
+def cache_database(
+    database: Dict[str, Callable[..., pd.DataFrame]]
+) -> Dict[str, Callable[..., pd.DataFrame]]:
+    """Put a HistoryCache in front of each query function if it is enabled."""
+    settings = cache_settings()
+    if not settings["enabled"]:
+        return database
+    folder = Path(settings["folder"]) if settings["folder"] else DEFAULT_FOLDER
+    return {
+        connection_type: HistoryCache(
+            connection_type,
+            query_data,
+            folder,
+            max_bytes=int(settings["max_gb"] * 2 ** 30),
+            fresh_horizon=dt.timedelta(hours=settings["fresh_hours"]),
+        )
+        for connection_type, query_data in database.items()
+    }
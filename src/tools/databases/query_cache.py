@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import datetime as dt
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Tuple
+
+import pandas as pd
+
+from tools.databases.connections import layered_settings
+from tools.utilities.tags import configs
+
+QUERY_CACHE_DEFAULTS = {
+    "enabled": False,
+    "max_mb": 512.0,
+    "ttl_seconds": 900.0,
+}
+
+
+def query_cache_settings() -> dict:
+    """Settings of the in process query cache.
+
+    Defaults are overridden by the [query_cache] table in config.toml and
+    then by environment variables named like QUERY_CACHE_MAX_MB.
+    """
+    return layered_settings(
+        QUERY_CACHE_DEFAULTS, configs.get("query_cache", {}), env_prefix="query_cache"
+    )
+
+
+def request_key(
+    connection_type: str,
+    which: str,
+    tags,
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    sample_freq: float,
+) -> Tuple[Hashable, ...]:
+    """Same key for requests that only differ in how they were written."""
+    if isinstance(tags, str):
+        tags = (tags,)
+    return (
+        connection_type,
+        which,
+        tuple(tags),
+        pd.Timestamp(start_date),
+        pd.Timestamp(end_date),
+        float(sample_freq),
+    )
+
+
+class QueryCache:
+    """Query results kept in memory, shared by every thread.
+
+    Results are dropped ttl_seconds after they were queried and least
+    recently used results are dropped once they take up more than
+    max_bytes. Identical requests made while the first is still running
+    wait for it instead of querying again. Every call gets its own copy
+    of the dataframe.
+
+    Example:
+        >>> cache = QueryCache(max_bytes=2 ** 29, ttl_seconds=900)
+        >>> query_data = cache.wrap("connection_2", query_analog_data)
+        >>> data = query_data("location_a", tags, start_date, end_date, 60)
+        >>> cache.stats()
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.results: OrderedDict = OrderedDict()
+        self.in_flight: Dict[Tuple[Hashable, ...], Future] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> QueryCache:
+        return cls(
+            max_bytes=int(settings["max_mb"] * 2 ** 20),
+            ttl_seconds=settings["ttl_seconds"],
+        )
+
+    def get(
+        self, key: Tuple[Hashable, ...], query: Callable[[], pd.DataFrame]
+    ) -> pd.DataFrame:
+        """Cached result for key, running query only if nobody else is."""
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.results.move_to_end(key)
+                self.hits += 1
+                return cached[2].copy()
+            if cached is not None:
+                self.drop(key)
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result().copy()
+
+        try:
+            data = query()
+        except BaseException as err:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(err)
+            raise
+        with self.lock:
+            del self.in_flight[key]
+            self.store(key, data.copy())
+        future.set_result(data)
+        return data.copy()
+
+    def store(self, key: Tuple[Hashable, ...], data: pd.DataFrame):
+        nbytes = int(data.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        self.results[key] = (time.monotonic() + self.ttl_seconds, nbytes, data)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self.drop(next(iter(self.results)))
+            self.evictions += 1
+
+    def drop(self, key: Tuple[Hashable, ...]):
+        _, nbytes, _ = self.results.pop(key)
+        self.nbytes -= nbytes
+
+    def wrap(
+        self, connection_type: str, query_data: Callable[..., pd.DataFrame]
+    ) -> Callable[..., pd.DataFrame]:
+        """query_data with its results going through the cache."""
+
+        def cached_query(which, tags, start_date, end_date, sample_freq=1):
+            key = request_key(
+                connection_type, which, tags, start_date, end_date, sample_freq
+            )
+            return self.get(
+                key,
+                lambda: query_data(which, tags, start_date, end_date, sample_freq),
+            )
+
+        cached_query.__doc__ = query_data.__doc__
+        return cached_query
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.results),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
+
+
+query_cache = QueryCache.from_settings(query_cache_settings())
+
+
+def cache_queries(
+    database: Dict[str, Callable[..., pd.DataFrame]]
+) -> Dict[str, Callable[..., pd.DataFrame]]:
+    """Put query_cache in front of each query function if it is enabled."""
+    if not query_cache_settings()["enabled"]:
+        return database
+    return {
+        connection_type: query_cache.wrap(connection_type, query_data)
+        for connection_type, query_data in database.items()
+    }
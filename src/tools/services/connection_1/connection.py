@@ -3,25 +3,285 @@ from __future__ import annotations
 
 import datetime as dt
 
-from typing import List
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 
 from pycygnet.cx_vhs import CxValueIterator
 
+from tools.databases.connections import layered_settings
+from tools.utilities.tags import configs
 
+READER_DEFAULTS = {
+    # more than one reads CygNet from pool threads, see init_com
+    "tag_workers": 1,
+    "tag_timeout": 0.0,
+}
 
-def add_noise(column, noise):
-    noise = np.random.normal(0, noise, len(column)).tolist()
-    noisy_vals = []
-    for val, noise in zip(column, noise):
-        if val == 0:
-            noisy_vals.append(0)
-        else:
-            noisy_vals.append(val + noise)
-    noisy_vals = np.asarray(noisy_vals)
-    return noisy_vals
+
+def reader_settings() -> dict:
+    """Settings of the tag reader.
+
+    Defaults are overridden by the [connection_1] table in config.toml and
+    then by environment variables named like CONNECTION_1_TAG_WORKERS.
+    """
+    table = configs.get("connection_1", {})
+    return layered_settings(
+        READER_DEFAULTS,
+        {name: table[name] for name in READER_DEFAULTS if name in table},
+        env_prefix="connection_1",
+    )
+
+
+@dataclass(frozen=True)
+class TagFamily:
+    """How a kind of tag is scaled, filled and given noise.
+
+    Params:
+        name: name of the family
+        tags: tags that are always in the family
+        match: tags containing any of these are in the family
+        fill: "hold" carries the last reading forward, "ffill" fills
+            nan values forward up to limit minutes and "ffill_bfill"
+            fills nan values forward and then backward
+        limit: most minutes "ffill" fills, 0 for no limit
+        divide_by: values are divided by this before filling
+        noise: standard deviation of the noise added to nonzero values
+    """
+
+    name: str
+    tags: Tuple[str, ...] = ()
+    match: Tuple[str, ...] = ()
+    fill: str = "hold"
+    limit: int = 0
+    divide_by: float = 1.0
+    noise: float = 0.0
+
+
+DEFAULT_FAMILIES = (
+    TagFamily("rate", match=("RATE",), fill="ffill", limit=14),
+    TagFamily("product", match=("PRODUCT",), fill="ffill_bfill"),
+    TagFamily(
+        "fuel", match=("FUEL",), fill="ffill_bfill", divide_by=1000.0, noise=0.02
+    ),
+    TagFamily(
+        "flow",
+        match=("INLET", "DISCHARGE"),
+        fill="ffill_bfill",
+        divide_by=1000.0,
+        noise=0.2,
+    ),
+    TagFamily("pressure", match=("PSI",), noise=0.3),
+)
+HOLD = TagFamily("hold")
+
+
+def load_tag_families() -> Tuple[TagFamily, ...]:
+    """[[connection_1.tag_families]] from config.toml, in order."""
+    families = configs.get("connection_1", {}).get("tag_families")
+    if not families:
+        return DEFAULT_FAMILIES
+    return tuple(
+        TagFamily(
+            **{
+                **family,
+                "tags": tuple(family.get("tags", ())),
+                "match": tuple(family.get("match", ())),
+            }
+        )
+        for family in families
+    )
+
+
+TAG_FAMILIES = load_tag_families()
+
+
+@lru_cache(maxsize=None)
+def tag_family(tag: str) -> TagFamily:
+    """Family listing the tag, or else the first family matching it."""
+    for family in TAG_FAMILIES:
+        if tag in family.tags:
+            return family
+    for family in TAG_FAMILIES:
+        if any(part in tag for part in family.match):
+            return family
+    return HOLD
+
+
+noise_generator = np.random.default_rng()
+
+
+def seed_noise(seed: Optional[int] = None):
+    """Restart the noise added to tags, the same seed gives the same noise."""
+    global noise_generator
+    noise_generator = np.random.default_rng(seed)
+
+
+def add_noise(
+    column: np.ndarray, noise: float, generator: Optional[np.random.Generator] = None
+) -> np.ndarray:
+    """Add normal noise to the nonzero values of column, in place."""
+    generator = noise_generator if generator is None else generator
+    nonzero = column != 0
+    column[nonzero] += generator.normal(0, noise, np.count_nonzero(nonzero))
+    return column
+
+
+MINUTE = np.timedelta64(1, "m")
+
+
+@lru_cache(maxsize=32)
+def minute_grid(start_date: dt.datetime, end_date: dt.datetime) -> pd.DatetimeIndex:
+    """Every minute from start_date to end_date, shared by every tag."""
+    return pd.date_range(start=start_date, end=end_date, freq="T", name="datetime")
+
+
+def align_to_grid(
+    grid: pd.DatetimeIndex, times: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Put readings on the minute they were taken in, the last one wins.
+
+    Returns:
+        (value for every minute of grid, nan where there was no reading,
+         whether there was a reading, even a nan one)
+    """
+    minutes = times.astype("datetime64[m]")
+    offsets, remainder = np.divmod(minutes - grid.values[0], MINUTE)
+    keep = (remainder == np.timedelta64(0)) & (offsets >= 0) & (offsets < len(grid))
+    column = np.full(len(grid), np.nan)
+    # numpy leaves repeated fancy index writes unordered, so drop them first
+    last = ~pd.Index(offsets).duplicated(keep="last") & keep
+    column[offsets[last]] = values[last]
+    read = np.zeros(len(grid), dtype=bool)
+    read[offsets[last]] = True
+    return column, read
+
+
+def forward_fill(
+    values: np.ndarray, limit: Optional[int] = None, read: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Array version of pandas ffill.
+
+    With read, only minutes without a reading are filled and nan readings
+    are carried forward too, like merge_ordered's fill_method="ffill".
+    """
+    positions = np.arange(len(values))
+    last = np.where(np.isnan(values) if read is None else ~read, -1, positions)
+    np.maximum.accumulate(last, out=last)
+    filled = np.where(last >= 0, values[last], np.nan)
+    if limit is not None:
+        filled[positions - last > limit] = np.nan
+    return filled
+
+
+def back_fill(values: np.ndarray) -> np.ndarray:
+    """Array version of pandas bfill."""
+    return forward_fill(values[::-1])[::-1]
+
+
+def fill_tag_values(tag: str, values: np.ndarray, read: np.ndarray) -> np.ndarray:
+    """Scale, fill and add noise to a tag's minute values as its family says."""
+    family = tag_family(tag)
+    if family.divide_by != 1:
+        values /= family.divide_by
+    if family.fill == "ffill":
+        values = forward_fill(values, limit=family.limit or None)
+    elif family.fill == "ffill_bfill":
+        values = back_fill(forward_fill(values))
+    else:
+        values = forward_fill(values, read=read)
+    if family.noise:
+        add_noise(values, family.noise)
+    return values
+
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+def read_tag_values(
+    site: str, tag: str, start_date: dt.datetime, end_date: dt.datetime
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Drain the historian values of one tag into typed arrays.
+
+    The values are collected in growable int64 and float64 buffers, 16
+    bytes a reading, which numpy then uses without copying.
+
+    Returns:
+        (datetime64[ns] reading times, float values with nan for no value)
+    """
+    hist_iterator = CxValueIterator(
+        site, tag_string=tag, earliest=start_date, latest=end_date
+    )
+    times = array("q")
+    values = array("d")
+    for val in hist_iterator:
+        elapsed = val.datetime - EPOCH
+        times.append(
+            (elapsed.days * 86400 + elapsed.seconds) * 1_000_000_000
+            + elapsed.microseconds * 1000
+        )
+        values.append(np.nan if val.value is None else val.value)
+    return (
+        np.frombuffer(times, dtype="datetime64[ns]"),
+        np.frombuffer(values, dtype=np.float64),
+    )
+
+
+def init_com():
+    """Set up COM in a pool thread, CygNet's client API is COM."""
+    try:
+        import pythoncom
+    except ImportError:
+        # pywin32 is only there on Windows, which is the only place with COM
+        return
+    pythoncom.CoInitialize()
+
+
+def read_all_tag_values(
+    site: str,
+    tags: List[str],
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    max_workers: int,
+    tag_timeout: Optional[float],
+) -> List[list]:
+    """read_tag_values for every tag, up to max_workers tags at a time.
+
+    tag_timeout only applies with more than one worker, reading tags one
+    after another waits for each as long as it takes. Each tag's timeout
+    counts from when its result is waited on, not from when its read
+    started, so tags queued behind slow ones get extra time.
+
+    Returns:
+        list: (times, values) of each tag, in the same order as tags
+    """
+    if max_workers <= 1:
+        return [read_tag_values(site, tag, start_date, end_date) for tag in tags]
+    pool = ThreadPoolExecutor(
+        max_workers=min(max_workers, len(tags)), initializer=init_com
+    )
+    futures = [
+        pool.submit(read_tag_values, site, tag, start_date, end_date) for tag in tags
+    ]
+    try:
+        all_values = []
+        for tag, future in zip(tags, futures):
+            try:
+                all_values.append(future.result(timeout=tag_timeout))
+            except TimeoutError as err:
+                raise LookupError(
+                    f"Timed out reading {tag} from {site} after {tag_timeout}s"
+                ) from err
+        return all_values
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
 
 
 def query_analog_data(
@@ -30,62 +290,105 @@ def query_analog_data(
     start_date: dt.datetime,
     end_date: dt.datetime,
     sample_freq=1,
+    max_workers: Optional[int] = None,
+    tag_timeout: Optional[float] = None,
 ):
+    """Query the historian for the tag values.
 
-    dataframes = []
+    Params:
+        site: site to pull from
+        tags: tag names to query for
+        start_date: earliest datetime to go to
+        end_date: latest datetime to go to
+        sample_freq: unused, values are always put on a minute grid
+        max_workers: tags read at the same time, defaults to
+            tag_workers in the [connection_1] config table
+        tag_timeout: seconds to wait on any one tag, defaults to
+            tag_timeout in the [connection_1] config table, 0 waits forever
+            only used with more than one worker, see read_all_tag_values
 
-    for tag in tags:
-        hist_iterator = CxValueIterator(
-            site, tag_string=tag, earliest=start_date, latest=end_date
-        )
-        values = [(val.datetime, val.value) for val in hist_iterator]
+    Returns:
+        dataframe: index is datetimes
+            columns are tags names
+    """
+    settings = reader_settings()
+    if max_workers is None:
+        max_workers = settings["tag_workers"]
+    if tag_timeout is None:
+        tag_timeout = settings["tag_timeout"] or None
+    all_values = read_all_tag_values(
+        site, tags, start_date, end_date, max_workers, tag_timeout
+    )
 
-        query_range = pd.date_range(start=start_date, end=end_date, freq="T")
-        blank_data = pd.DataFrame(
-            np.nan, columns=["datetime", "value"], index=range(0, len(query_range))
-        )
-        blank_data["datetime"] = query_range
-
-        data = pd.DataFrame(values, columns=["datetime", "value"])
-        data["datetime"] = pd.to_datetime(data["datetime"], format="%Y-%m-%d %H:%M")
-        data["datetime"] = data.datetime.map(
-            lambda x: x.replace(second=0, microsecond=0)
-        ).drop_duplicates(keep="last")
-        data = data.dropna(subset=["datetime"])
-        if "RATE" in tag or "GRATE" in tag:
-            data = pd.merge_ordered(blank_data, data, on="datetime")
-            data = data.ffill(limit=14)
-        elif "PRODUCT" in tag:
-            data = pd.merge_ordered(blank_data, data, on="datetime")
-            data = data.ffill().bfill()
-        elif (
-            "INLET" in tag
-            or "FUEL" in tag
-            or "DISCHARGE" in tag
-        ):
-            data = pd.merge_ordered(blank_data, data, on="datetime")
-            data["value_y"] = data.value_y / 1000
-            data = data.ffill().bfill()
-            if "FUEL" in tag:
-                data["value_y"] = add_noise(data.value_y.values.tolist(), 0.02)
-            else:
-                data["value_y"] = add_noise(data.value_y.values.tolist(), 0.2)
-        elif "PSI" in tag:
-            data = pd.merge_ordered(
-                blank_data, data, fill_method="ffill", on="datetime"
-            )
-            data["value_y"] = add_noise(data.value_y.values.tolist(), 0.3)
-        else:
-            data = pd.merge_ordered(
-                blank_data, data, fill_method="ffill", on="datetime"
-            )
-        data = data.set_index("datetime")
-        data["tagname"] = tag.split(":")[-1].lower()
-        data = data.pivot(columns="tagname", values="value_y")
-        data.drop(data.index[:1], inplace=True)
-        data.columns = data.columns.str.lower()
-        dataframes.append(data.copy())
-
-    all_data = pd.concat(dataframes, join="inner", axis=1, sort=True)
+    grid = minute_grid(start_date, end_date)
+    wide = np.empty((len(grid), len(tags)))
+    for column, (tag, (times, readings)) in enumerate(zip(tags, all_values)):
+        wide[:, column] = fill_tag_values(tag, *align_to_grid(grid, times, readings))
+
+    # the first minute only seeds the fills
+    all_data = pd.DataFrame(
+        wide[1:],
+        index=grid[1:],
+        columns=pd.Index([tag.split(":")[-1].lower() for tag in tags], name="tagname"),
+        copy=False,
+    )
     all_data = all_data.dropna(how="any")
     return all_data
+
+
+STREAM_CHUNK = dt.timedelta(days=1)
+# longest limited forward fill, for RATE and GRATE tags
+LEAD_IN = dt.timedelta(minutes=15)
+
+
+def stream_analog_data(
+    site: str,
+    tags: List[str],
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    sample_freq=1,
+    chunk: dt.timedelta = STREAM_CHUNK,
+    lead_in: dt.timedelta = LEAD_IN,
+) -> Iterator[pd.DataFrame]:
+    """query_analog_data one chunk at a time for windows too big for memory.
+
+    Each chunk is its own query, started lead_in early so the limited
+    forward fills carry across chunk edges. The first chunk starts at
+    start_date like query_analog_data, so nothing before the window is
+    filled in. Unlimited fills of PRODUCT, INLET, FUEL, DISCHARGE and PSI
+    tags only reach back as far as lead_in.
+
+    Params:
+        site: site to pull from
+        tags: tag names to query for
+        start_date: earliest datetime to go to
+        end_date: latest datetime to go to
+        sample_freq: passed on to query_analog_data
+        chunk: timespan of each dataframe, chunks end on multiples of it
+            so days end at midnight
+        lead_in: extra history read before each chunk
+
+    Yields:
+        dataframe: same as query_analog_data, for one chunk
+            chunks without any values are skipped
+    """
+    step = pd.Timedelta(chunk)
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start.floor(step) + step, end)
+        # readings a few seconds after chunk_end still belong to its minute
+        query_end = min(chunk_end + pd.Timedelta(minutes=1), end)
+        query_start = chunk_start - lead_in if chunk_start > start else start
+        data = query_analog_data(
+            site,
+            tags,
+            query_start.to_pydatetime(),
+            query_end.to_pydatetime(),
+            sample_freq,
+        )
+        data = data[(data.index > chunk_start) & (data.index <= chunk_end)]
+        if len(data):
+            yield data
+        chunk_start = chunk_end
@@ -2,9 +2,14 @@
 from __future__ import annotations
 
 import datetime as dt
+import threading
 
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
 from sqlalchemy import and_, sql
@@ -20,17 +25,49 @@ from .location_e.tables import t_AnalogHistory as location_e_analog
 from .location_f.tables import t_AnalogHistory as location_f_analog
 
 
+# engines are looked up by name on each query so importing this module
+# does not build any of them
 historian = {
-    "location_a": (engines("marshall_history_engine"), location_a_analog),
-    "location_b": (engines("milton_history_engine"), location_b_analog),
-    "location_c": (engines("shiner_history_engine"), location_c_analog),
-    "location_d": (engines("smiley_history_engine"), location_d_analog),
-    "location_e": (engines("lyssy_history_engine"), location_e_analog),
-    "location_f": (engines("titan_history_engine"), location_f_analog),
+    "location_a": ("history_engine_a", location_a_analog),
+    "location_b": ("history_engine_b", location_b_analog),
+    "location_c": ("history_engine_c", location_c_analog),
+    "location_d": ("history_engine_d", location_d_analog),
+    "location_e": ("history_engine_e", location_e_analog),
+    "location_f": ("history_engine_f", location_f_analog),
 }
 
+MAX_WORKERS = 6
+HISTORIAN_CONCURRENCY = 2
+# wwResolution is a 32 bit integer of milliseconds, about 24.8 days
+MAX_RESOLUTION_MS = 2 ** 31 - 1
 
-def query_statement(table, tags, start_datetime, end_datetime, sample_freq):
+historian_limits = {
+    key: threading.BoundedSemaphore(HISTORIAN_CONCURRENCY) for key in historian
+}
+
+
+@contextmanager
+def historian_slot(which_historian: str, timeout: Optional[float] = None):
+    """Hold one of the historian's query slots, shared by every thread."""
+    limit = historian_limits[which_historian]
+    if not limit.acquire(timeout=-1 if timeout is None else timeout):
+        raise LookupError(f"Timed out waiting for a {which_historian} query slot")
+    try:
+        yield
+    finally:
+        limit.release()
+
+
+def query_statement(
+    table,
+    tags,
+    start_datetime,
+    end_datetime,
+    sample_freq,
+    include_start=False,
+    retrieval_mode="Cyclic",
+    cycle_count=None,
+):
     """Make query statement to get values for tags.
 
     Params:
@@ -40,24 +77,101 @@ def query_statement(table, tags, start_datetime, end_datetime, sample_freq):
         end_datetime: latest datetime to get values for
         sample_freq: number of seconds between samples
             connection_2 will interpolate 
+        include_start: also return values at exactly start_datetime
+        retrieval_mode: historian wwRetrievalMode, how each sample is
+            worked out from the stored values
+        cycle_count: split the window into this many samples instead of
+            sampling every sample_freq seconds
 
     Returns:
         sqlalchemy created query statement
 
     """
+    if include_start:
+        after_start = table.c.DateTime >= start_datetime
+    else:
+        after_start = table.c.DateTime > start_datetime
+    if cycle_count is not None:
+        samples = table.c.wwCycleCount == cycle_count
+    else:
+        resolution = 1000 * sample_freq  # convert from seconds to milliseconds
+        if resolution > MAX_RESOLUTION_MS:
+            raise ValueError(
+                f"sample_freq of {sample_freq} seconds is over the historian's "
+                f"{MAX_RESOLUTION_MS / 1000} second wwResolution limit"
+            )
+        samples = table.c.wwResolution == resolution
     statement = sql.select([table.c.TagName, table.c.Value, table.c.DateTime]).where(
         and_(
-            table.c.DateTime > start_datetime,
+            after_start,
             table.c.DateTime < end_datetime,
             table.c.TagName.in_(tags),
-            table.c.wwRetrievalMode == "Cyclic",
-            table.c.wwResolution
-            == 1000 * sample_freq,  # convert from seconds to milliseconds
+            table.c.wwRetrievalMode == retrieval_mode,
+            samples,
         )
     )
     return statement
 
 
+def read_analog_rows(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+    include_start: bool = False,
+) -> pd.DataFrame:
+    """Read the long format tagname, value, datetime rows for the tags."""
+    engine_name, table = historian[which_historian]
+    engine = engines(engine_name)
+    statement = query_statement(
+        table, tags, start_datetime, end_datetime, sample_freq, include_start
+    )
+    try:
+        return pd.read_sql(statement, engine)
+    except OperationalError as err:
+        raise LookupError(
+            f"Could not retrieve data for {tags} from {which_historian} connnection: {engine!r}"
+        ) from err
+
+
+def pivot_analog_rows(data: pd.DataFrame, fill_missing: bool = True) -> pd.DataFrame:
+    """Turn long format historian rows into one column per tag.
+
+    Missing values become 0 unless fill_missing is False.
+    """
+    data.columns = data.columns.str.lower()
+    data["tagname"] = data["tagname"].str.lower()
+    data["datetime"] = pd.to_datetime(data["datetime"])
+    if fill_missing:
+        data["value"] = data["value"].fillna(0)
+    return data.pivot_table(
+        index="datetime", columns="tagname", values="value", dropna=False
+    )
+
+
+def finish_analog_data(
+    data: pd.DataFrame, which_historian: str, tags: List[str], sample_freq: float
+) -> pd.DataFrame:
+    """Put pivoted values on a regular index and fill short gaps."""
+    data = data.asfreq("60S")
+    data.index = pd.DatetimeIndex(data.index, freq=f"{sample_freq}s", name="datetime")
+    return fill_analog_gaps(data, which_historian, tags)
+
+
+def fill_analog_gaps(
+    data: pd.DataFrame, which_historian: str, tags: List[str]
+) -> pd.DataFrame:
+    """Fill short gaps in values already on a regular index."""
+    data = data.fillna(data.rolling(window=20, center=True, min_periods=20).mean())
+    if which_historian == "titan":
+        for tag in tags:
+            if "DischargeROC" in tag:
+                data[str(tag.lower())] = data[str(tag.lower())] / 1000
+
+    return data
+
+
 def query_analog_data(
     which_historian: str,
     tags: List[str],
@@ -81,27 +195,555 @@ def query_analog_data(
         dataframe: index is datetimes
             columns are tags names
     """
-    engine, table = historian[which_historian]
-    statement = query_statement(table, tags, start_datetime, end_datetime, sample_freq)
+    data = read_analog_rows(
+        which_historian, tags, start_datetime, end_datetime, sample_freq
+    )
+    data = pivot_analog_rows(data)
+    return finish_analog_data(data, which_historian, tags, sample_freq)
+
+
+# historian retrieval modes, its averages are always time weighted
+RETRIEVAL_MODES = {
+    "average": "Average",
+    "time_weighted_average": "Average",
+    "min": "Min",
+    "max": "Max",
+    "integral": "Integral",
+}
+
+
+@dataclass(frozen=True)
+class Aggregation:
+    """Values the historian works out per resolution instead of per sample.
+
+    Example:
+        >>> daily_means = Aggregation("average", dt.timedelta(days=1))
+        >>> window_max = Aggregation("max", end_datetime - start_datetime)
+    """
+
+    how: str
+    resolution: dt.timedelta
+
+    def __post_init__(self):
+        if self.how not in RETRIEVAL_MODES:
+            raise ValueError(f"{self.how!r} is not one of {sorted(RETRIEVAL_MODES)}")
+        if self.resolution <= dt.timedelta(0):
+            raise ValueError(f"resolution must be positive, not {self.resolution}")
+
+    @property
+    def retrieval_mode(self) -> str:
+        return RETRIEVAL_MODES[self.how]
+
+    @property
+    def seconds(self) -> float:
+        return self.resolution.total_seconds()
+
+
+def query_aggregate_data(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    aggregation: Aggregation,
+) -> pd.DataFrame:
+    """Query the historian for aggregated tag values.
+
+    The historian aggregates before sending anything back, so weekly or
+    monthly summaries return one row per period instead of every minute.
+    Periods longer than wwResolution can hold are queried one at a time as
+    a single cycle, so are aggregations over the whole window. Periods
+    without any values are left missing.
+
+    Params:
+        which_historian: which historian to pull from
+            options are historian.keys()
+        tags: tag names in historian to query for
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        aggregation: how and over what timespan to aggregate
+
+    Returns:
+        dataframe: index is the datetime of each period
+            columns are tags names
+    """
+    engine_name, table = historian[which_historian]
+    engine = engines(engine_name)
+    if 1000 * aggregation.seconds <= MAX_RESOLUTION_MS and (
+        start_datetime + aggregation.resolution < end_datetime
+    ):
+        statements = [
+            query_statement(
+                table,
+                tags,
+                start_datetime,
+                end_datetime,
+                aggregation.seconds,
+                include_start=True,
+                retrieval_mode=aggregation.retrieval_mode,
+            )
+        ]
+    else:
+        period_starts = pd.date_range(
+            start_datetime, end_datetime, freq=aggregation.resolution
+        )
+        period_starts = period_starts[period_starts < end_datetime]
+        statements = [
+            query_statement(
+                table,
+                tags,
+                period_start,
+                min(period_start + aggregation.resolution, end_datetime),
+                None,
+                include_start=True,
+                retrieval_mode=aggregation.retrieval_mode,
+                cycle_count=1,
+            )
+            for period_start in period_starts.to_pydatetime()
+        ]
     try:
-        data = pd.read_sql(statement, engine)
+        data = pd.concat(
+            [pd.read_sql(statement, engine) for statement in statements],
+            ignore_index=True,
+        )
     except OperationalError as err:
         raise LookupError(
             f"Could not retrieve data for {tags} from {which_historian} connnection: {engine!r}"
         ) from err
-    data.columns = data.columns.str.lower()
-    data["tagname"] = data["tagname"].str.lower()
-    data["datetime"] = pd.to_datetime(data["datetime"])
-    data["value"] = data["value"].fillna(0)
-    data = data.pivot_table(
-        index="datetime", columns="tagname", values="value", dropna=False
+    return pivot_analog_rows(data, fill_missing=False)
+
+
+# wwTagKey never changes for a tag, so each is only looked up once, by its
+# lower case name since the historian matches tag names in any case
+tag_key_cache: Dict[str, Dict[str, int]] = {key: {} for key in historian}
+tag_key_lock = threading.Lock()
+
+
+def tag_keys(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+) -> Dict[str, int]:
+    """Look up the historian's integer wwTagKey for each tag.
+
+    Tags the historian has no values for in the window are left out.
+
+    Returns:
+        dict: wwTagKey keyed by lower case tag name
+    """
+    cache = tag_key_cache[which_historian]
+    with tag_key_lock:
+        missing = [tag for tag in tags if tag.lower() not in cache]
+    if missing:
+        engine_name, table = historian[which_historian]
+        engine = engines(engine_name)
+        # a single cyclic row per tag is enough to read its key
+        statement = (
+            sql.select([table.c.TagName, table.c.wwTagKey])
+            .where(
+                and_(
+                    table.c.DateTime >= start_datetime,
+                    table.c.DateTime < end_datetime,
+                    table.c.TagName.in_(missing),
+                    table.c.wwRetrievalMode == "Cyclic",
+                    table.c.wwCycleCount == 1,
+                )
+            )
+            .distinct()
+        )
+        try:
+            with engine.connect() as connection:
+                found = dict(connection.execute(statement).fetchall())
+        except OperationalError as err:
+            raise LookupError(
+                f"Could not retrieve tag keys for {missing} from {which_historian} connnection: {engine!r}"
+            ) from err
+        with tag_key_lock:
+            cache.update((tag.lower(), key) for tag, key in found.items())
+    names = [tag.lower() for tag in tags]
+    return {name: cache[name] for name in names if name in cache}
+
+
+def read_analog_grid(
+    which_historian: str,
+    keys: Dict[str, int],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+) -> pd.DataFrame:
+    """Read values by wwTagKey straight onto a minute by tag grid.
+
+    Params:
+        which_historian: which historian to pull from
+        keys: wwTagKey keyed by lower case tag name, from tag_keys
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        sample_freq: timespan between recordings in seconds
+
+    Returns:
+        dataframe: same grid as finish_analog_data's before gaps are filled
+    """
+    engine_name, table = historian[which_historian]
+    engine = engines(engine_name)
+    statement = sql.select(
+        [table.c.wwTagKey, table.c.Value, table.c.DateTime]
+    ).where(
+        and_(
+            table.c.DateTime > start_datetime,
+            table.c.DateTime < end_datetime,
+            table.c.wwTagKey.in_(list(keys.values())),
+            table.c.wwRetrievalMode == "Cyclic",
+            table.c.wwResolution == 1000 * sample_freq,
+        )
     )
-    data = data.asfreq("60S")
-    data.index = pd.DatetimeIndex(data.index, freq=f"{sample_freq}s", name="datetime")
-    data = data.fillna(data.rolling(window=20, center=True, min_periods=20).mean())
-    if which_historian == "titan":
-        for tag in tags:
-            if "DischargeROC" in tag:
-                data[str(tag.lower())] = data[str(tag.lower())] / 1000
+    try:
+        rows = pd.read_sql(statement, engine, parse_dates=["DateTime"])
+    except OperationalError as err:
+        raise LookupError(
+            f"Could not retrieve data for {list(keys)} from {which_historian} connnection: {engine!r}"
+        ) from err
 
-    return data
+    names = [tag.lower() for tag in keys]
+    key_array = np.fromiter(keys.values(), dtype=np.int64, count=len(keys))
+    by_key = np.argsort(key_array)
+    row_keys = rows["wwTagKey"].to_numpy(dtype=np.int64)
+    tag_positions = by_key[np.searchsorted(key_array, row_keys, sorter=by_key)]
+
+    # like pivot_table, only tags with values get a column, sorted by name
+    present = sorted(np.unique(tag_positions), key=lambda i: names[i])
+    column_of = np.empty(len(keys), dtype=np.intp)
+    column_of[present] = np.arange(len(present))
+    columns = pd.Index([names[i] for i in present], name="tagname")
+
+    step = np.timedelta64(60, "s")
+    times = rows["DateTime"].to_numpy(dtype="datetime64[ns]")
+    if not len(times):
+        index = pd.DatetimeIndex([], freq=f"{sample_freq}s", name="datetime")
+        return pd.DataFrame(index=index, columns=columns, dtype=float)
+    first = times.min()
+    n_minutes = (times.max() - first) // step + 1
+    offsets, remainder = np.divmod(times - first, step)
+    # like asfreq, values off the minute grid are dropped
+    on_grid = remainder == np.timedelta64(0, "ns")
+
+    values = np.full((n_minutes, len(columns)), np.nan)
+    values[offsets[on_grid], column_of[tag_positions[on_grid]]] = (
+        rows["Value"].fillna(0).to_numpy(dtype=float)[on_grid]
+    )
+    index = pd.DatetimeIndex(
+        first + step * np.arange(n_minutes), freq=f"{sample_freq}s", name="datetime"
+    )
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def query_analog_data_columnar(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+) -> pd.DataFrame:
+    """query_analog_data without the long format rows and pivot.
+
+    Values are read by integer wwTagKey instead of tag name and written
+    straight into one preallocated array, which keeps memory and parse time
+    down for wide tag sets.
+
+    Params:
+        which_historian: which historian to pull from
+        tags: tag names in historian to query for
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        sample_freq: timespan between recordings in seconds
+
+    Returns:
+        dataframe: same as query_analog_data
+    """
+    keys = tag_keys(which_historian, tags, start_datetime, end_datetime)
+    if not keys:
+        raise LookupError(f"No tag keys for {tags} in {which_historian}")
+    data = read_analog_grid(
+        which_historian, keys, start_datetime, end_datetime, sample_freq
+    )
+    return fill_analog_gaps(data, which_historian, tags)
+
+
+MAX_SHARD_ROWS = 500_000
+
+
+def plan_shards(
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    n_tags: int,
+    sample_freq: float = 1,
+    max_rows: int = MAX_SHARD_ROWS,
+) -> List[Tuple[dt.datetime, dt.datetime]]:
+    """Split a window into shards of at most max_rows historian rows.
+
+    Shard lengths are a whole number of samples, so every shard stays on the
+    same cyclic grid as the full window.
+    """
+    samples = max(max_rows // max(n_tags, 1), 1)
+    step = dt.timedelta(seconds=samples * sample_freq)
+    shards = []
+    shard_start = start_datetime
+    while shard_start < end_datetime:
+        shard_end = min(shard_start + step, end_datetime)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
+
+
+def read_pivoted_shard(
+    which_historian: str,
+    tags: List[str],
+    shard: Tuple[dt.datetime, dt.datetime],
+    sample_freq: float,
+    include_start: bool,
+    timeout: Optional[float],
+) -> pd.DataFrame:
+    with historian_slot(which_historian, timeout):
+        data = read_analog_rows(
+            which_historian, tags, *shard, sample_freq, include_start
+        )
+    return pivot_analog_rows(data)
+
+
+def query_analog_data_sharded(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+    max_rows: int = MAX_SHARD_ROWS,
+    max_workers: int = HISTORIAN_CONCURRENCY,
+    timeout: Optional[float] = None,
+) -> pd.DataFrame:
+    """query_analog_data for long windows, split into shards read in parallel.
+
+    The first shard keeps the strict start of query_analog_data and every
+    later shard includes its start, so each boundary timestamp is read
+    exactly once.
+
+    Params:
+        which_historian: which historian to pull from
+        tags: tag names in historian to query for
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        sample_freq: timespan between recordings in seconds
+        max_rows: most historian rows in one shard
+        max_workers: shards read at the same time, also capped by the
+            historian's query slots
+        timeout: seconds to wait for a query slot
+
+    Returns:
+        dataframe: same as query_analog_data
+    """
+    shards = plan_shards(start_datetime, end_datetime, len(tags), sample_freq, max_rows)
+    if len(shards) <= 1:
+        return query_analog_data(
+            which_historian, tags, start_datetime, end_datetime, sample_freq
+        )
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(
+                read_pivoted_shard,
+                which_historian,
+                tags,
+                shard,
+                sample_freq,
+                i > 0,
+                timeout,
+            )
+            for i, shard in enumerate(shards)
+        ]
+        frames = [future.result() for future in futures]
+    # a tag missing from the first shard would otherwise come last
+    data = pd.concat(frames, sort=False).sort_index(axis=1)
+    return finish_analog_data(data, which_historian, tags, sample_freq)
+
+
+STREAM_CHUNK = dt.timedelta(days=1)
+FETCH_ROWS = 50_000
+# finish_analog_data's centered 20 minute rolling fill looks this far
+# past either side of a chunk
+FILL_MARGIN = dt.timedelta(minutes=20)
+
+
+def chunk_edges(
+    start_datetime: dt.datetime, end_datetime: dt.datetime, chunk: dt.timedelta
+) -> List[pd.Timestamp]:
+    """Ends of the chunks covering the window, aligned to multiples of chunk."""
+    step = pd.Timedelta(chunk)
+    edge = pd.Timestamp(start_datetime).floor(step) + step
+    edges = []
+    while edge < end_datetime:
+        edges.append(edge)
+        edge += step
+    edges.append(pd.Timestamp(end_datetime))
+    return edges
+
+
+def stream_analog_data(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+    chunk: dt.timedelta = STREAM_CHUNK,
+    fetch_rows: int = FETCH_ROWS,
+) -> Iterator[pd.DataFrame]:
+    """query_analog_data one chunk at a time for windows too big for memory.
+
+    One query is streamed from the historian fetch_rows rows at a time, so
+    only a chunk and the fill margin around it are ever held. The chunks
+    put back together are the same as query_analog_data's dataframe. The
+    historian connection stays checked out until the generator is done.
+
+    Params:
+        which_historian: which historian to pull from
+        tags: tag names in historian to query for
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        sample_freq: timespan between recordings in seconds
+        chunk: timespan of each dataframe, chunks start on multiples of
+            it so days start at midnight
+        fetch_rows: historian rows fetched from the cursor at a time
+
+    Yields:
+        dataframe: same as query_analog_data, for one chunk
+            chunks without any values are skipped
+    """
+    engine_name, table = historian[which_historian]
+    engine = engines(engine_name)
+    statement = query_statement(
+        table, tags, start_datetime, end_datetime, sample_freq
+    ).order_by(table.c.DateTime)
+    edges = chunk_edges(start_datetime, end_datetime, chunk)
+    chunk_start = pd.Timestamp(start_datetime)
+    wide = None
+    carry = None
+    try:
+        with engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for rows in pd.read_sql(statement, connection, chunksize=fetch_rows):
+                if carry is not None:
+                    rows = pd.concat([carry, rows], ignore_index=True)
+                # the last timestamp may have more tags in the next fetch
+                held = rows["DateTime"] == rows["DateTime"].iloc[-1]
+                carry = rows[held]
+                if held.all():
+                    continue
+                pivoted = pivot_analog_rows(rows[~held].copy())
+                wide = pd.concat([wide, pivoted], sort=False)
+                while edges and wide.index[-1] >= edges[0] + FILL_MARGIN:
+                    chunk_end = edges.pop(0)
+                    data, wide = split_finished(
+                        wide, which_historian, tags, sample_freq, chunk_start, chunk_end
+                    )
+                    chunk_start = chunk_end
+                    if len(data):
+                        yield data
+    except OperationalError as err:
+        raise LookupError(
+            f"Could not retrieve data for {tags} from {which_historian} connnection: {engine!r}"
+        ) from err
+
+    if carry is not None:
+        wide = pd.concat([wide, pivot_analog_rows(carry.copy())], sort=False)
+    while wide is not None and edges:
+        chunk_end = edges.pop(0)
+        data, wide = split_finished(
+            wide, which_historian, tags, sample_freq, chunk_start, chunk_end
+        )
+        chunk_start = chunk_end
+        if len(data):
+            yield data
+
+
+def split_finished(
+    wide: pd.DataFrame,
+    which_historian: str,
+    tags: List[str],
+    sample_freq: float,
+    chunk_start: pd.Timestamp,
+    chunk_end: pd.Timestamp,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Finish one chunk of pivoted values and drop what it no longer needs.
+
+    Returns:
+        (finished chunk, pivoted values still needed for later chunks)
+    """
+    wide = wide.sort_index(axis=1)
+    # one row either side of the margins too, so asfreq still fills in a
+    # gap running across a chunk edge
+    stop = wide.index.searchsorted(chunk_end + FILL_MARGIN) + 1
+    data = finish_analog_data(wide.iloc[:stop], which_historian, tags, sample_freq)
+    data = data[(data.index >= chunk_start) & (data.index < chunk_end)]
+    first = max(wide.index.searchsorted(chunk_end - FILL_MARGIN) - 1, 0)
+    return data, wide.iloc[first:]
+
+
+def limited_query(
+    which_historian: str,
+    tags: List[str],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+    timeout: Optional[float] = None,
+) -> pd.DataFrame:
+    with historian_slot(which_historian, timeout):
+        return query_analog_data(
+            which_historian, tags, start_datetime, end_datetime, sample_freq
+        )
+
+
+def query_historians(
+    historian_tags: Mapping[str, Sequence[str]],
+    start_datetime: dt.datetime,
+    end_datetime: dt.datetime,
+    sample_freq: float = 1,
+    max_workers: int = MAX_WORKERS,
+    timeout: Optional[float] = None,
+) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Query several historians at once.
+
+    Params:
+        historian_tags: tags to query keyed by historian
+            options for the keys are historian.keys()
+        start_datetime: earliest datetime to go to
+        end_datetime: latest datetime to go to
+        sample_freq: timespan between recordings in seconds
+        max_workers: most queries running at the same time, each
+            historian is further capped at HISTORIAN_CONCURRENCY
+        timeout: seconds to wait for all the historians
+
+    Yields:
+        (historian, dataframe) in the order the queries complete
+            dataframes are the same as query_analog_data's
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        pool.submit(
+            limited_query,
+            which_historian,
+            list(tags),
+            start_datetime,
+            end_datetime,
+            sample_freq,
+            timeout,
+        ): which_historian
+        for which_historian, tags in historian_tags.items()
+    }
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            yield futures[future], future.result()
+    except TimeoutError as err:
+        pending = sorted(
+            which for future, which in futures.items() if not future.done()
+        )
+        raise LookupError(f"Timed out waiting for data from {pending}") from err
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
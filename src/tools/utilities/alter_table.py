@@ -4,33 +4,16 @@ import datetime as dt
 import numpy as np
 import pandas as pd
 
-from numpy import inf
 from scipy.integrate import cumtrapz
 
-from tools.algorithms.production_filtering import infer_prod_rate
+from tools.algorithms.production_filtering import product_calculations  # noqa: F401
 from tools.utilities.tags import GetTags
-from tools.utilities.build_table import get_time_sum_values, get_zero_values
+from tools.utilities.build_table import get_grouped_time_sum_values, get_zero_values
 
-CONNECTION = GetTags().connection
-CONNECTION_TYPE = GetTags().connection_type
-TRUCKED = GetTags().trucked
-
-
-def product_calculations(data):
-    filtered_measurements = infer_prod_rate(data).reshape(-1, 3)
-    infered_fillrate = filtered_measurements[:, 2]
-    scfm = (data.inlet_flowrate * 1000) / 1440
-    per_inlet_values = infered_fillrate / scfm
-    per_inlet_values[per_inlet_values < 0] = 0
-    per_inlet_values[per_inlet_values == inf] = 0
-
-    results = []
-    for result in infered_fillrate:
-        if result < 0:
-            result = 0
-        results.append(result)
-    cumulative_values = np.cumsum(results)
-    return per_inlet_values, cumulative_values
+location_tags = GetTags()
+CONNECTION = location_tags.connection
+CONNECTION_TYPE = location_tags.connection_type
+TRUCKED = location_tags.trucked
 
 
 def calculate_product_totals(location, data):
@@ -72,18 +55,9 @@ def get_location_data(
     trucked,
     sum_values=True,
 ):
-    all_tbls = []
-
-    for tag, col in zip(tags, columns):
-        if sum_values == True:
-            tbl = get_time_sum_values(
-                CONNECTION(location), tag, col, start_date, end_date
-            )
-        else:
-            tbl = get_time_sum_values(
-                CONNECTION(location), tag, col, start_date, end_date, sum_values=False
-            )
-        all_tbls.append(tbl)
+    all_tbls = get_grouped_time_sum_values(
+        CONNECTION(location), tags, columns, start_date, end_date, sum_values
+    )
     if trucked == "YES":
         condensate_flowrate_data = get_zero_values("product_flowrate", start_date, end_date)
         all_tbls.append(condensate_flowrate_data)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Run fill and drain inference for every level based chemical tank.
+
+Historian data is pulled once per location in the parent process, cut into
+shifts and handed to a process pool as plain numpy arrays. Each worker
+rebuilds a small frame and runs infer_fill_and_drain and
+calculate_chemical_usage on it.
+
+Example:
+    >>> usage = run_chemical_usage(start_date, end_date, workers=8)
+"""
+from __future__ import annotations
+
+import datetime as dt
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tools.algorithms.fill_and_drain_inference import (
+    calculate_chemical_usage,
+    infer_fill_and_drain,
+)
+from tools.utilities.tags import INDEX, GetTags, find_location
+
+CHEMICALS = ("chemical_a", "chemical_b", "chemical_c", "chemical_d", "chemical_e")
+SHIFT = pd.Timedelta(hours=12)
+PADDING = pd.Timedelta(hours=1)
+
+
+@dataclass
+class UsageJob:
+    location: str
+    chemical: str
+    shift_start: dt.datetime
+    shift_end: dt.datetime
+    times: np.ndarray
+    tank_volume: np.ndarray
+    inlet_flowrate: np.ndarray
+
+
+def chemical_usage_job(job: UsageJob) -> dict:
+    data = pd.DataFrame(
+        {"tank_volume": job.tank_volume, "inlet_flowrate": job.inlet_flowrate},
+        index=pd.DatetimeIndex(job.times.view("datetime64[ns]"), name="datetime"),
+    )
+    changes, inlet_flowrate = infer_fill_and_drain(
+        data, job.shift_start, job.shift_end
+    )
+    return {
+        "location": job.location,
+        "chemical": job.chemical,
+        "shift_start": job.shift_start,
+        "shift_end": job.shift_end,
+        "chemical_usage": calculate_chemical_usage(changes),
+        "fills": len(changes),
+        "inlet_flowrate": inlet_flowrate,
+    }
+
+
+def level_based_chemicals(
+    location: str, chemicals: Sequence[str] = CHEMICALS
+) -> List[str]:
+    measurements = find_location(location).measurements
+    return [
+        chemical
+        for chemical in chemicals
+        if chemical in measurements
+        and measurements[chemical].usage_function == "level_based"
+    ]
+
+
+def shift_windows(
+    start_date: dt.datetime, end_date: dt.datetime, shift: pd.Timedelta = SHIFT
+) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    starts = pd.date_range(start_date, end_date, freq=shift)
+    return [
+        (start, start + shift - pd.Timedelta(1, "min"))
+        for start in starts[starts < end_date]
+    ]
+
+
+def location_jobs(
+    location: str,
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    shift: pd.Timedelta = SHIFT,
+    padding: pd.Timedelta = PADDING,
+    chemicals: Sequence[str] = CHEMICALS,
+) -> List[UsageJob]:
+    """Pull a location's chemical tanks and inlet once and cut them into jobs."""
+    # imported here so pool workers never build the historian engines
+    from tools.utilities.alter_table import get_location_data
+
+    tags = GetTags()
+    chemicals = level_based_chemicals(location, chemicals)
+    if not chemicals:
+        return []
+    data = get_location_data(
+        location,
+        [getattr(tags, f"{chemical}_volume")(location) for chemical in chemicals]
+        + [tags.inlet_flowrate(location)],
+        chemicals + ["inlet_flowrate"],
+        start_date - padding,
+        end_date + padding,
+        tags.trucked(location),
+    )
+    times = data.index.values.astype("datetime64[ns]").view(np.int64)
+    inlet_flowrate = data["inlet_flowrate"].values
+
+    jobs = []
+    for shift_start, shift_end in shift_windows(start_date, end_date, shift):
+        first, last = np.searchsorted(
+            times, [(shift_start - padding).value, (shift_end + padding).value]
+        )
+        if first == last:
+            continue
+        for chemical in chemicals:
+            jobs.append(
+                UsageJob(
+                    location,
+                    chemical,
+                    shift_start,
+                    shift_end,
+                    times[first:last],
+                    data[chemical].values[first:last],
+                    inlet_flowrate[first:last],
+                )
+            )
+    return jobs
+
+
+def run_jobs(jobs: Iterable[UsageJob], workers: Optional[int] = None) -> pd.DataFrame:
+    """Run usage jobs on a process pool, or in process when workers is 1."""
+    if workers == 1:
+        results = [chemical_usage_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # jobs are consumed lazily, so the pool starts on the first
+            # location while the next one is still being pulled
+            futures = [pool.submit(chemical_usage_job, job) for job in jobs]
+            results = [future.result() for future in futures]
+    return tidy_results(results)
+
+
+def run_chemical_usage(
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    locations: Optional[Iterable[str]] = None,
+    shift: pd.Timedelta = SHIFT,
+    padding: pd.Timedelta = PADDING,
+    workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """Chemical usage per location, chemical and shift.
+
+    Params:
+        start_date: start of the first shift
+        end_date: end of the last shift
+        locations: locations in config.toml, all of them by default
+        shift: length of a shift
+        padding: extra data pulled on both sides of a shift so the
+            filters are settled by the time the shift starts
+        workers: number of worker processes, defaults to the cpu count
+
+    Returns:
+        dataframe: one row per location, chemical and shift
+    """
+    if locations is None:
+        locations = list(INDEX.locations)
+    jobs = (
+        job
+        for location in locations
+        for job in location_jobs(location, start_date, end_date, shift, padding)
+    )
+    return run_jobs(jobs, workers)
+
+
+def tidy_results(results: List[dict]) -> pd.DataFrame:
+    columns = [
+        "location",
+        "chemical",
+        "shift_start",
+        "shift_end",
+        "chemical_usage",
+        "fills",
+        "inlet_flowrate",
+    ]
+    data = pd.DataFrame(results, columns=columns)
+    return data.sort_values(["location", "chemical", "shift_start"], ignore_index=True)
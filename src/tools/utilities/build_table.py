@@ -4,10 +4,18 @@ import pandas as pd
 
 from numpy import inf
 
+from tools.databases.history_cache import CONNECTIONS, cache_database
+from tools.databases.query_cache import cache_queries
 from tools.services.connection_1.connection import query_analog_data as connection_1_data
 from tools.services.connection_2.connection import query_analog_data as connection_2_data
 
-DATABASE = {"connection_1": connection_1_data, "connection_2": connection_2_data}
+# reads go through the in process query cache and then the local parquet
+# cache, when [query_cache] and [history_cache] enable them
+DATABASE = cache_queries(
+    cache_database(
+        {"connection_1": connection_1_data, "connection_2": connection_2_data}
+    )
+)
 
 
 def get_time_sum_values(
@@ -19,6 +27,10 @@ def get_time_sum_values(
     connection = connection["which"]
 
     data = query_data(connection, tags, start_date, end_date, 60)  # --sample every 60s
+    return sum_time_values(data, column_name, sum_values)
+
+
+def sum_time_values(data, column_name, sum_values=True):
     data[data == inf] = 0
     if sum_values == True:
         data = data.sum(axis=1)
@@ -30,6 +42,53 @@ def get_time_sum_values(
     return data
 
 
+def get_grouped_time_sum_values(
+    connection, tag_groups, column_names, start_date, end_date, sum_values=True
+) -> list:
+    """get_time_sum_values for several tag groups with a single query.
+
+    Every tag is read in one IN (...) query and the wide result is split
+    back into the groups. Connections that drop rows missing any tag would
+    let one group's gaps remove the others' rows, so those are still
+    queried a group at a time.
+
+    Params:
+        connection: connection args of the location
+        tag_groups: tag or tuple of tags for each output
+        column_names: column name for each output, a list of names per
+            tag when sum_values is False
+        start_date: earliest datetime to go to
+        end_date: latest datetime to go to
+        sum_values: sum each group's tags into one column
+
+    Returns:
+        list: get_time_sum_values output for each group, in order
+    """
+    tag_groups = [
+        (tags,) if isinstance(tags, str) else tuple(tags) for tags in tag_groups
+    ]
+    rules = CONNECTIONS[connection["type"]]
+    if rules.drops_incomplete:
+        return [
+            get_time_sum_values(
+                connection, tags, column_name, start_date, end_date, sum_values
+            )
+            for tags, column_name in zip(tag_groups, column_names)
+        ]
+
+    query_data = DATABASE[connection["type"]]
+    all_tags = list(dict.fromkeys(tag for tags in tag_groups for tag in tags))
+    data = query_data(connection["which"], all_tags, start_date, end_date, 60)
+    return [
+        sum_time_values(
+            data.reindex(columns=[rules.column(tag) for tag in tags]),
+            column_name,
+            sum_values,
+        )
+        for tags, column_name in zip(tag_groups, column_names)
+    ]
+
+
 def get_zero_values(column_name, start_date, end_date):
     idx = pd.date_range(start=start_date, end=end_date, freq="T")
     values = [0.0] * len(idx)
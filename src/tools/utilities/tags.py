@@ -1,104 +1,294 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional, Tuple, Union
 
 import toml
 
 config_folder = Path(__file__).resolve().parents[1] / "configs"
 config_file = config_folder / "config.toml"
-
-with config_file.open() as f:
-    configs = toml.load(f)
+index_file = config_folder / "config.toml.index"
+
+# bump when the index classes change so old index files are rebuilt
+INDEX_VERSION = 2
+
+
+class FrozenDict(dict):
+    """dict that can't be changed once built."""
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} can't be changed")
+
+    __setitem__ = __delitem__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+@dataclass(frozen=True)
+class Measurement:
+    """One measured thing at a location, like its fuel flowrate."""
+
+    name: Union[str, Tuple[str, ...], None]
+    tags: Tuple[str, ...]
+    usage_function: Union[str, bool]
+    units: Union[str, bool]
+
+
+@dataclass(frozen=True)
+class Location:
+    key: str
+    name: str
+    trucked: str
+    connection: FrozenDict
+    designation: Optional[str]
+    area: Optional[str]
+    measurements: FrozenDict
+
+    @property
+    def connection_type(self) -> str:
+        return self.connection["type"]
+
+
+@dataclass(frozen=True)
+class ConfigIndex:
+    """Locations of config.toml, compiled for quick lookups.
+
+    tag_locations has every (location, measurement) a tag is used for.
+    """
+
+    locations: FrozenDict
+    tag_locations: FrozenDict
+
+
+def frozen(value):
+    if isinstance(value, list):
+        return tuple(frozen(item) for item in value)
+    if isinstance(value, dict):
+        return FrozenDict((key, frozen(item)) for key, item in value.items())
+    return value
+
+
+def thawed(value):
+    """Lists and dicts again, for callers that expect the parsed toml."""
+    if isinstance(value, tuple):
+        return [thawed(item) for item in value]
+    if isinstance(value, dict):
+        return {key: thawed(item) for key, item in value.items()}
+    return value
+
+
+def compile_index(configs: dict) -> ConfigIndex:
+    locations = {}
+    tag_locations = {}
+    for key, config in configs.items():
+        if "connection_args" not in config:
+            continue
+        measurements = {}
+        for measurement, tables in config.items():
+            if not (isinstance(tables, list) and tables and "tags" in tables[0]):
+                continue
+            table = tables[0]
+            measurements[measurement] = Measurement(
+                name=frozen(table.get("name")),
+                tags=tuple(table["tags"]),
+                usage_function=table.get("usage_function", False),
+                units=table.get("units", False),
+            )
+            for tag in table["tags"]:
+                tag_locations.setdefault(tag, []).append((key, measurement))
+        place = config.get("location", [{}])[0]
+        locations[key] = Location(
+            key=key,
+            name=config["name"],
+            trucked=config["trucked"],
+            connection=frozen(config["connection_args"][0]),
+            designation=place.get("designation"),
+            area=place.get("area"),
+            measurements=FrozenDict(measurements),
+        )
+    return ConfigIndex(
+        locations=FrozenDict(locations),
+        tag_locations=FrozenDict(
+            (tag, tuple(uses)) for tag, uses in tag_locations.items()
+        ),
+    )
+
+
+def load_configs(
+    config_file: Path = config_file, index_file: Path = index_file
+) -> Tuple[dict, ConfigIndex]:
+    """Parsed config.toml and its index, from index_file while it is current.
+
+    index_file is trusted while the config's modified time and size are
+    unchanged, and after that while the config's hash is, so imports
+    normally skip parsing the toml.
+    """
+    stat = config_file.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    header = saved = None
+    try:
+        with index_file.open("rb") as f:
+            # the header only holds plain values, so an index of another
+            # version is skipped before unpickling classes it may name
+            header = pickle.load(f)
+            if header["version"] == INDEX_VERSION:
+                saved = pickle.load(f)
+    except Exception:
+        # a missing, half written or otherwise unreadable index is rebuilt
+        header = saved = None
+    if saved is not None and header["stamp"] == stamp:
+        return saved
+
+    text = config_file.read_bytes()
+    digest = hashlib.sha256(text).hexdigest()
+    if saved is not None and header["digest"] == digest:
+        configs, index = saved
+    else:
+        configs = toml.loads(text.decode("utf-8"))
+        index = compile_index(configs)
+    save_index(
+        index_file,
+        {"version": INDEX_VERSION, "stamp": stamp, "digest": digest},
+        (configs, index),
+    )
+    return configs, index
+
+
+def save_index(index_file: Path, header: dict, saved: tuple):
+    """Write index_file whole, so processes starting together never read half
+    of one."""
+    try:
+        handle, temp = tempfile.mkstemp(suffix=".tmp", dir=index_file.parent)
+    except OSError:
+        # a read only install still works, it just parses every time
+        return
+    try:
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, index_file)
+    except OSError:
+        # another process may have the index open on Windows, it wrote the same
+        os.remove(temp)
+
+
+configs, INDEX = load_configs()
 
 TAGS = configs.items()
 
 
+def find_location(key: str) -> Location:
+    return INDEX.locations[key]
+
+
+def find_measurement(key: str, name: str) -> Measurement:
+    return INDEX.locations[key].measurements[name]
+
+
+def tag_locations(tag: str) -> Tuple[Tuple[str, str], ...]:
+    """(location, measurement) for every use of the tag."""
+    return INDEX.tag_locations.get(tag, ())
+
+
 class GetTags:
+    """Location config lookups, as lists and dicts like the parsed toml."""
+
     def __init__(self):
         self.configs = configs
+        self.index = INDEX
 
     def name(self, location):
-        return self.configs[location]["name"]
+        return find_location(location).name
 
     def connection(self, location):
-        return self.configs[location]["connection_args"][0]
+        return thawed(find_location(location).connection)
 
     def connection_type(self, location):
-        return self.configs[location]["connection_args"][0]["type"]
+        return find_location(location).connection_type
 
     def designation(self, location):
-        return self.configs[location]["location"][0]["designation"]
+        return find_location(location).designation
 
     def inlet_flowrate(self, location):
-        return self.configs[location]["inlet"][0]["tags"]
+        return thawed(find_measurement(location, "inlet_flowrate").tags)
 
     def pipeline_pressure(self, location):
-        return self.configs[location]["inlet_pressure"][0]["tags"]
+        return thawed(find_measurement(location, "inlet_pressure").tags)
 
     def inlet_names(self, location):
-        return self.configs[location]["inlet_pressure"][0]["name"]
+        return thawed(find_measurement(location, "inlet_pressure").name)
 
     def discharge_flowrate(self, location):
-        return self.configs[location]["discharge_flowrate"][0]["tags"]
+        return thawed(find_measurement(location, "discharge_flowrate").tags)
 
     def liquid_product_flowrate(self, location):
-        return self.configs[location]["liquid_product_flowrate"][0]["tags"]
+        return thawed(find_measurement(location, "liquid_product_flowrate").tags)
 
     def product_tank_volume(self, location):
-        return self.configs[location]["product_tank_vol"][0]["tags"]
+        return thawed(find_measurement(location, "product_tank_vol").tags)
 
     def trucked(self, location):
-        return self.configs[location]["trucked"]
+        return find_location(location).trucked
 
     def fuel(self, location):
-        return self.configs[location]["fuel_flowrate"][0]["name"]
+        return thawed(find_measurement(location, "fuel_flowrate").name)
 
     def fuel_flowrate(self, location):
-        return self.configs[location]["fuel_flowrate"][0]["tags"]
+        return thawed(find_measurement(location, "fuel_flowrate").tags)
 
     def fuel_measurement(self, location):
-        return self.configs[location]["fuel_flowrate"][0]["usage_function"]
+        return find_measurement(location, "fuel_flowrate").usage_function
 
     def chemical_a(self, location):
-        return self.configs[location]["chemical_a"][0]["name"]
+        return thawed(find_measurement(location, "chemical_a").name)
 
     def chemical_a_volume(self, location):
-        return self.configs[location]["chemical_a"][0]["tags"]
+        return thawed(find_measurement(location, "chemical_a").tags)
 
     def chemical_a_measurement(self, location):
-        return self.configs[location]["chemical_a"][0]["usage_function"]
+        return find_measurement(location, "chemical_a").usage_function
 
     def chemical_b(self, location):
-        return self.configs[location]["chemical_b"][0]["name"]
+        return thawed(find_measurement(location, "chemical_b").name)
 
     def chemical_b_volume(self, location):
-        return self.configs[location]["chemical_b"][0]["tags"]
+        return thawed(find_measurement(location, "chemical_b").tags)
 
     def chemical_b_measurement(self, location):
-        return self.configs[location]["chemical_b"][0]["usage_function"]
+        return find_measurement(location, "chemical_b").usage_function
 
     def chemical_c(self, location):
-        return self.configs[location]["chemical_c"][0]["name"]
+        return thawed(find_measurement(location, "chemical_c").name)
 
     def chemical_c_volume(self, location):
-        return self.configs[location]["chemical_c"][0]["tags"]
+        return thawed(find_measurement(location, "chemical_c").tags)
 
     def chemical_c_measurement(self, location):
-        return self.configs[location]["chemical_c"][0]["usage_function"]
+        return find_measurement(location, "chemical_c").usage_function
 
     def chemical_d(self, location):
-        return self.configs[location]["chemical_d"][0]["name"]
+        return thawed(find_measurement(location, "chemical_d").name)
 
     def chemical_d_volume(self, location):
-        return self.configs[location]["chemical_d"][0]["tags"]
+        return thawed(find_measurement(location, "chemical_d").tags)
 
     def chemical_d_measurement(self, location):
-        return self.configs[location]["chemical_d"][0]["usage_function"]
+        return find_measurement(location, "chemical_d").usage_function
 
     def chemical_e(self, location):
-        return self.configs[location]["chemical_e"][0]["name"]
+        return thawed(find_measurement(location, "chemical_e").name)
 
     def chemical_e_volume(self, location):
-        return self.configs[location]["chemical_e"][0]["tags"]
+        return thawed(find_measurement(location, "chemical_e").tags)
 
     def chemical_e_measurement(self, location):
-        return self.configs[location]["chemical_e"][0]["usage_function"]
+        return find_measurement(location, "chemical_e").usage_function